@@ -0,0 +1,131 @@
+import cProfile
+import heapq
+import inspect
+import io
+import os
+import pstats
+import time
+from collections import defaultdict
+from itertools import count
+from pathlib import Path
+
+class Instrumentation:
+    '''
+    opt-in timing around Answer.run. attach() shadows run on one Answer instance, so answers that are
+    never attached pay nothing. per method it keeps call counts, cumulative time and a log2 latency
+    histogram; every `profile_every`-th call runs under cProfile and the `slowest` sampled calls are kept
+    '''
+
+    def __init__(self, profile_every=0, slowest=5, profile_dir=None):
+        self.calls = defaultdict(int)
+        self.total_ns = defaultdict(int)
+        self.max_ns = defaultdict(int)
+        self.histogram = defaultdict(lambda: defaultdict(int)) # method -> latency bit length -> calls
+        self.log_lengths = defaultdict(lambda: defaultdict(int)) # timeline -> length bit length -> timelines
+        self.profile_every = profile_every
+        self.slowest = slowest
+        self.profile_dir = profile_dir
+        self.profiles = [] # min-heap of (ns, seq, method, args, profile) for the slowest sampled calls
+        self.seq = count()
+
+    @classmethod
+    def from_env(cls):
+        '''instrumentation configured by ANSWER_INSTRUMENT=1 and ANSWER_PROFILE_EVERY / _SLOWEST / _DIR, or None'''
+        if os.environ.get("ANSWER_INSTRUMENT", "0") in ("", "0"):
+            return None
+        profile_dir = os.environ.get("ANSWER_PROFILE_DIR")
+        return cls(profile_every=int(os.environ.get("ANSWER_PROFILE_EVERY", 0)),
+                   slowest=int(os.environ.get("ANSWER_PROFILE_SLOWEST", 5)),
+                   profile_dir=Path(profile_dir) if profile_dir else None)
+
+    def attach(self, answer):
+        run, clock = answer.run, time.perf_counter_ns
+
+        def timed_run(method, *args, **kwargs):
+            seq = next(self.seq)
+            profile = cProfile.Profile() if self.profile_every and seq % self.profile_every == 0 else None
+            start = clock()
+            try:
+                output = run(method, *args, **kwargs) if profile is None else profile.runcall(run, method, *args, **kwargs)
+            except Exception: # rejected calls are timed too
+                self._record(method, clock() - start)
+                raise
+            elapsed = clock() - start
+            if profile is not None:
+                self._sample(elapsed, seq, method, args, profile)
+            if inspect.isgenerator(output): # streamed results are timed until the consumer is done with them
+                return self._timed_stream(method, output, elapsed)
+            self._record(method, elapsed)
+            return output
+
+        answer.run = timed_run
+        return answer
+
+    def _timed_stream(self, method, output, elapsed):
+        clock = time.perf_counter_ns
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(output)
+                except StopIteration:
+                    elapsed += clock() - start
+                    return
+                elapsed += clock() - start
+                yield item
+        finally:
+            self._record(method, elapsed)
+
+    def _record(self, method, elapsed):
+        self.calls[method] += 1
+        self.total_ns[method] += elapsed
+        self.max_ns[method] = max(self.max_ns[method], elapsed)
+        self.histogram[method][elapsed.bit_length()] += 1
+
+    def _sample(self, elapsed, seq, method, args, profile):
+        entry = (elapsed, seq, method, args, profile)
+        if len(self.profiles) < self.slowest:
+            heapq.heappush(self.profiles, entry)
+        elif elapsed > self.profiles[0][0]:
+            heapq.heapreplace(self.profiles, entry)
+
+    def observe(self, answer):
+        '''record the event log lengths of an answer that reports them through log_lengths()'''
+        lengths = getattr(answer, "log_lengths", None)
+        if lengths is None:
+            return
+        for timeline, length in lengths():
+            self.log_lengths[timeline][length.bit_length()] += 1
+
+    @staticmethod
+    def _quantile(buckets, q):
+        '''upper bound of the log2 bucket holding the q-quantile'''
+        target, seen = q * sum(buckets.values()), 0
+        for bits in sorted(buckets):
+            seen += buckets[bits]
+            if seen >= target:
+                return (1 << bits) - 1
+        return 0
+
+    def report(self):
+        out = io.StringIO()
+        out.write(f"\n{'method':<28}{'calls':>10}{'total ms':>12}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}\n")
+        for method in sorted(self.calls, key=self.total_ns.get, reverse=True):
+            calls, buckets = self.calls[method], self.histogram[method]
+            out.write(f"{method:<28}{calls:>10}{self.total_ns[method] / 1e6:>12.2f}{self.total_ns[method] / calls / 1e3:>10.2f}"
+                      f"{min(self._quantile(buckets, 0.5), self.max_ns[method]) / 1e3:>10.2f}"
+                      f"{min(self._quantile(buckets, 0.99), self.max_ns[method]) / 1e3:>10.2f}{self.max_ns[method] / 1e3:>10.2f}\n")
+        for timeline in sorted(self.log_lengths):
+            buckets = self.log_lengths[timeline]
+            spread = "  ".join(f"<{1 << bits}: {buckets[bits]}" for bits in sorted(buckets))
+            out.write(f"\n{timeline} log lengths    {spread}")
+        if self.log_lengths:
+            out.write("\n")
+        for rank, (elapsed, seq, method, args, profile) in enumerate(sorted(self.profiles, reverse=True)):
+            out.write(f"\nslowest sampled call #{rank}: {method}{tuple(args)} in {elapsed / 1e3:.2f} us (call {seq})\n")
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(8)
+            if self.profile_dir is not None:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                stats.dump_stats(self.profile_dir / f"slowest{rank}_{method}.prof")
+        return out.getvalue()
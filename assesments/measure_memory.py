@@ -0,0 +1,36 @@
+import argparse
+import tracemalloc
+from pathlib import Path
+
+from run_test_cases import load_answer
+
+def bytes_per_package(module, count, updates):
+    '''traced bytes held by a registry of `count` packages, each with `updates` weight changes, per package'''
+    tracemalloc.start()
+    answer = module.Answer()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        answer.run("PKG_CREATE_AT", i, f"PKG{i:08d}", 100, f"CITY{i % 50}")
+        for j in range(updates):
+            answer.run("PKG_SET_WEIGHT_AT", i + j + 1, f"PKG{i:08d}", 101 + j)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used / count
+
+def main(args):
+    module = load_answer(args.answer)
+    for updates in (0, 1, 10):
+        print(f"updates per package: {updates:>3}    bytes per package: {bytes_per_package(module, args.count, updates):.1f}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--answer",     type=Path, default=Path(__file__).parent / "packages" / "answer.py",
+                                        help="path to the answer.py implementation to measure")
+    parser.add_argument("--count",      type=int, default=100_000,
+                                        help="number of packages to create")
+
+    args = parser.parse_args()
+
+    main(args)
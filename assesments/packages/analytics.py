@@ -0,0 +1,130 @@
+import numpy as np
+
+class FleetColumns:
+    '''
+    read-only columnar copy of a registry for fleet-wide time queries. package i has its creation and
+    earliest delivery time in create_ts[i] / delivery_ts[i] (untimed packages are created at -1 and
+    never delivered), and its weight and destination events in the flattened (ts, value) columns
+    between *_offsets[i] and *_offsets[i+1]. destinations are stored as codes into `destinations`.
+    queries take an array of timestamps and answer for all of them at once
+    '''
+    never = np.iinfo(np.int64).max
+
+    def __init__(self, ids, create_ts, delivery_ts, weight, destination, destinations):
+        self.ids = ids
+        self.create_ts = create_ts
+        self.delivery_ts = delivery_ts
+        self.weight_offsets, self.weight_ts, self.weight_vals = weight
+        self.dest_offsets, self.dest_ts, self.dest_codes = destination
+        self.destinations = destinations
+        self.n = len(ids)
+        # creations and deliveries in time order, to count live packages without a per-package pass
+        self.sorted_create = np.sort(create_ts)
+        self.sorted_delivery = np.sort(delivery_ts)
+        # every event keyed by (owning package, rank of its timestamp) in one ascending int64, so the events of
+        # a package as of a time are one searchsorted per package. ranks keep owner * width far from overflowing
+        self.event_ts = np.unique(np.concatenate([self.weight_ts, self.dest_ts]))
+        self.width = len(self.event_ts) + 1
+        self.weight_key = self._key(self.weight_offsets, self.weight_ts)
+        self.dest_key = self._key(self.dest_offsets, self.dest_ts)
+        self.owner_base = np.arange(self.n, dtype=np.int64) * self.width
+
+    @classmethod
+    def from_answer(cls, answer):
+        '''freeze the packages of an Answer, in tracking_id order'''
+        answer.compact()
+        pids = sorted(answer.pkgs)
+        create_ts, delivery_ts = [], []
+        weight_counts, weight_ts, weight_vals = [], [], []
+        dest_counts, dest_ts, dest_codes = [], [], []
+        for pid in pids:
+            pkg = answer.pkgs[pid]
+            create_ts.append(-1 if pkg.create_ts is None else pkg.create_ts)
+            until = pkg.active_until()
+            delivery_ts.append(cls.never if until == float("inf") else until)
+            events = pkg.events("weight")
+            weight_counts.append(len(events))
+            for ts, val in events:
+                weight_ts.append(ts)
+                weight_vals.append(val)
+            events = pkg.events("destination")
+            dest_counts.append(len(events))
+            for ts, code in events: # the registry's interned destination codes
+                dest_ts.append(ts)
+                dest_codes.append(code)
+        return cls(
+            ids=np.array(pids, dtype=object),
+            create_ts=np.array(create_ts, dtype=np.int64),
+            delivery_ts=np.array(delivery_ts, dtype=np.int64),
+            weight=(cls._offsets(weight_counts), np.array(weight_ts, dtype=np.int64), np.array(weight_vals, dtype=np.int64)),
+            destination=(cls._offsets(dest_counts), np.array(dest_ts, dtype=np.int64), np.array(dest_codes, dtype=np.int64)),
+            destinations=np.array(answer.dest_names, dtype=object),
+        )
+
+    @staticmethod
+    def _offsets(counts):
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+
+    def _key(self, offsets, ts):
+        owner = np.repeat(np.arange(self.n, dtype=np.int64), np.diff(offsets))
+        return owner * self.width + np.searchsorted(self.event_ts, ts)
+
+    def _latest(self, key, offsets, vals, timestamp, missing, rows=slice(None)):
+        '''
+        values of the latest event at or before the timestamp of the packages in rows (all by default), in
+        O(rows log events) time and O(rows) space
+        '''
+        # events ranked below the query's rank happened at or before it; ends[i] is one past package i's latest one
+        rank = np.searchsorted(self.event_ts, timestamp, side="right")
+        ends = np.searchsorted(key, self.owner_base[rows] + rank, side="left")
+        return np.where(ends > offsets[:-1][rows], vals[ends - 1], missing)
+
+    def _as_of(self, key, offsets, vals, timestamps, missing):
+        '''(len(timestamps), n) values of each package's latest event at or before each timestamp'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        result = np.empty((len(timestamps), self.n), dtype=vals.dtype)
+        for row, timestamp in enumerate(timestamps):
+            result[row] = self._latest(key, offsets, vals, timestamp, missing)
+        return result
+
+    # AS_OF queries
+    def alive_as_of(self, timestamps):
+        '''(len(timestamps), n) mask of packages that existed and were not delivered at each timestamp'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)[:, None]
+        return (self.create_ts <= timestamps) & (timestamps < self.delivery_ts)
+
+    def weight_as_of(self, timestamps):
+        return self._as_of(self.weight_key, self.weight_offsets, self.weight_vals, timestamps, 0)
+
+    def dest_as_of(self, timestamps):
+        '''destination codes, -1 where a package has no destination yet'''
+        return self._as_of(self.dest_key, self.dest_offsets, self.dest_codes, timestamps, -1)
+
+    def count_active(self, timestamps):
+        '''number of live packages at each timestamp'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        created = np.searchsorted(self.sorted_create, timestamps, side="right")
+        delivered = np.searchsorted(self.sorted_delivery, timestamps, side="right")
+        return created - delivered
+
+    # group by destination
+    def _by_dest(self, timestamps, weights):
+        '''one timestamp at a time, so the scratch space is O(n) rather than O(n * len(timestamps))'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        result = np.zeros((len(timestamps), len(self.destinations)))
+        for row, timestamp in enumerate(timestamps):
+            alive = np.flatnonzero((self.create_ts <= timestamp) & (timestamp < self.delivery_ts))
+            codes = self._latest(self.dest_key, self.dest_offsets, self.dest_codes, timestamp, -1, alive)
+            values = self._latest(self.weight_key, self.weight_offsets, self.weight_vals, timestamp, 0, alive) if weights else None
+            result[row] = np.bincount(codes, weights=values, minlength=len(self.destinations))
+        return result
+
+    def count_by_dest(self, timestamps):
+        '''(len(timestamps), len(destinations)) live package counts per destination'''
+        return self._by_dest(timestamps, weights=False).astype(np.int64)
+
+    def total_weight_by_dest(self, timestamps):
+        '''(len(timestamps), len(destinations)) total weight of the live packages headed to each destination'''
+        return self._by_dest(timestamps, weights=True).astype(np.int64)
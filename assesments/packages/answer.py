@@ -1,109 +1,1196 @@
-from dataclasses import dataclass, field
-from bisect import bisect_right, insort
-from typing import List, Tuple, Callable
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from itertools import chain, islice, repeat
+from operator import itemgetter
+from pathlib import Path
+import gc
+import heapq
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
 
 class OpSeq:
-    _next = 0
+    '''monotonic op ids that keep events sharing a timestamp in insertion order; each registry owns one'''
+    def __init__(self, last=0):
+        self._next = last
+
+    def next(self):
+        self._next += 1
+        return self._next
+
+    def last(self):
+        return self._next
+
+class SortedKeys:
+    '''
+    sorted set of unique keys stored as a list of bounded sorted buckets, so inserts and
+    removals only shift one bucket instead of the whole sequence
+    '''
+    _load = 512
+
+    def __init__(self, keys=()):
+        self._lists = []
+        self._maxes = []
+        self._len = 0
+        for key in keys:
+            self.add(key)
+
+    @classmethod
+    def from_sorted(cls, keys):
+        '''build from a list of unique keys in ascending order, one bucket at a time'''
+        self = cls()
+        self._lists = [keys[i:i+cls._load] for i in range(0, len(keys), cls._load)]
+        self._maxes = [sub[-1] for sub in self._lists]
+        self._len = len(keys)
+        return self
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._lists)
+
+    def __contains__(self, key):
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return False
+        sub = self._lists[i]
+        j = bisect_left(sub, key)
+        return j < len(sub) and sub[j] == key
+
+    def add(self, key):
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+        if key > self._maxes[-1]: # appending past the end, e.g. ascending timestamps
+            i, sub = len(self._maxes) - 1, self._lists[-1]
+            sub.append(key)
+        else:
+            i = bisect_left(self._maxes, key)
+            sub = self._lists[i]
+            j = bisect_left(sub, key)
+            if sub[j] == key:
+                return
+            sub.insert(j, key)
+        self._maxes[i] = sub[-1]
+        self._len += 1
+        if len(sub) > 2 * self._load: # split oversized buckets
+            self._lists.insert(i + 1, sub[self._load:])
+            del sub[self._load:]
+            self._maxes.insert(i, sub[-1])
+
+    def discard(self, key):
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return
+        sub = self._lists[i]
+        j = bisect_left(sub, key)
+        if j == len(sub) or sub[j] != key:
+            return
+        del sub[j]
+        self._len -= 1
+        if sub:
+            self._maxes[i] = sub[-1]
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+
+    def head(self, n):
+        return list(islice(self, n))
+
+    def pop_after(self, key):
+        '''remove and return every key greater than key, in order'''
+        i = bisect_right(self._maxes, key)
+        if i == len(self._maxes):
+            return []
+        sub = self._lists[i]
+        j = bisect_right(sub, key)
+        popped = sub[j:]
+        for rest in self._lists[i+1:]:
+            popped.extend(rest)
+        del sub[j:]
+        del self._lists[i+1:]
+        del self._maxes[i+1:]
+        if sub:
+            self._maxes[i] = sub[-1]
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+        self._len -= len(popped)
+        return popped
+
+    def pop_until(self, key):
+        '''remove and return every key less than or equal to key, in order'''
+        i = bisect_right(self._maxes, key)
+        popped = list(chain.from_iterable(self._lists[:i]))
+        del self._lists[:i]
+        del self._maxes[:i]
+        if self._lists:
+            sub = self._lists[0]
+            j = bisect_right(sub, key)
+            popped.extend(sub[:j])
+            del sub[:j]
+        self._len -= len(popped)
+        return popped
+
+class IntervalIndex:
+    '''
+    [start, end) intervals ordered by (start, key) in bounded buckets that remember the furthest end
+    they reach, so a stabbing query skips whole buckets of intervals that closed before the query time
+    '''
+    _load = 256
+
+    def __init__(self):
+        self._items = [] # buckets of sorted (start, key)
+        self._ends = [] # buckets of the matching end times
+        self._maxes = [] # last (start, key) of each bucket
+        self._reach = [] # largest end of each bucket
+
     @classmethod
-    def next(cls):
-        cls._next += 1
-        return cls._next
+    def from_sorted(cls, intervals):
+        '''build from a list of (start, key, end) in ascending (start, key) order, one bucket at a time'''
+        self = cls()
+        for i in range(0, len(intervals), cls._load):
+            bucket = intervals[i:i+cls._load]
+            self._items.append([(start, key) for start, key, _ in bucket])
+            self._ends.append([end for _, _, end in bucket])
+            self._maxes.append(self._items[-1][-1])
+            self._reach.append(max(self._ends[-1]))
+        return self
+
+    def _locate(self, key, start):
+        item = (start, key)
+        i = bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            return i, None
+        return i, bisect_left(self._items[i], item)
+
+    def add(self, key, start, end):
+        item = (start, key)
+        if not self._maxes:
+            self._items.append([item])
+            self._ends.append([end])
+            self._maxes.append(item)
+            self._reach.append(end)
+            return
+        i, j = self._locate(key, start)
+        if j is None:
+            i, j = i - 1, len(self._items[i-1])
+        items, ends = self._items[i], self._ends[i]
+        items.insert(j, item)
+        ends.insert(j, end)
+        self._maxes[i] = items[-1]
+        self._reach[i] = max(self._reach[i], end)
+        if len(items) > 2 * self._load: # split oversized buckets
+            self._items.insert(i + 1, items[self._load:])
+            self._ends.insert(i + 1, ends[self._load:])
+            del items[self._load:]
+            del ends[self._load:]
+            self._maxes.insert(i, items[-1])
+            self._reach[i:i+1] = [max(ends), max(self._ends[i+1])]
+
+    def update(self, key, start, end):
+        i, j = self._locate(key, start)
+        ends = self._ends[i]
+        ends[j] = end
+        self._reach[i] = max(ends)
+
+    def discard(self, key, start):
+        i, j = self._locate(key, start)
+        if j is None or j == len(self._items[i]) or self._items[i][j] != (start, key):
+            return
+        items, ends = self._items[i], self._ends[i]
+        del items[j]
+        del ends[j]
+        if items:
+            self._maxes[i] = items[-1]
+            self._reach[i] = max(ends)
+        else:
+            del self._items[i], self._ends[i], self._maxes[i], self._reach[i]
+
+    def stab(self, t):
+        '''yield the keys whose interval contains t, in (start, key) order'''
+        for _, key in self.stab_items(t):
+            yield key
+
+    def stab_items(self, t):
+        '''yield (start, key) for every interval containing t, in order. t=None is contained in every interval'''
+        if t is None:
+            for items in self._items:
+                yield from items
+            return
+        for items, ends, reach in zip(self._items, self._ends, self._reach):
+            if items[0][0] > t:
+                return
+            if reach <= t:
+                continue
+            for item, end in zip(items, ends):
+                if item[0] > t:
+                    return
+                if end > t:
+                    yield item
 
-@dataclass
 class EventLog:
-    events: List[Tuple[int, int, float|int|str]] = field(default_factory=list)
-    _key: Callable = lambda x: (x[0], x[1])
+    '''
+    timeline of (ts, op_id, val) events ordered by (ts, op_id). timestamps and op ids live in
+    parallel array('q') columns; in-order events are appended in O(1), late events are buffered
+    and merged into the columns on the next read
+    '''
+    __slots__ = ("ts", "ops", "vals", "_late")
+    _untimed = -1 # stored timestamp of events recorded without one (level 1 methods)
+
+    def __init__(self):
+        self.ts = array("q")
+        self.ops = array("q")
+        self.vals = []
+        self._late = []
+
+    def __len__(self):
+        return len(self.vals) + len(self._late)
+
+    def __iter__(self):
+        self._merge()
+        return zip(self.ts, self.ops, self.vals)
 
     def append(self, ts, op_id, val):
-        insort(self.events, (ts, op_id, val), key=self._key)
+        if ts is None:
+            ts = self._untimed
+        if not self.ts or ts > self.ts[-1] or (ts == self.ts[-1] and op_id > self.ops[-1]):
+            self.ts.append(ts)
+            self.ops.append(op_id)
+            self.vals.append(val)
+        else:
+            self._late.append((ts, op_id, val))
+
+    def extend(self, events):
+        '''append a run of (ts, op_id, val) events whose op ids are newer than every stored one'''
+        events.sort(key=lambda e: e[0]) # stable, so events sharing a timestamp stay in op order
+        if not self.ts or events[0][0] >= self.ts[-1]:
+            self.ts.extend([e[0] for e in events])
+            self.ops.extend([e[1] for e in events])
+            self.vals.extend([e[2] for e in events])
+        else:
+            self._late.extend(events)
+
+    def _merge(self):
+        if not self._late:
+            return
+        late, self._late = sorted(self._late, key=lambda x: (x[0], x[1])), []
+        if len(late) * 8 > len(self.vals): # cheaper to rebuild the columns than to shift them per event
+            events = sorted(chain(zip(self.ts, self.ops, self.vals), late), key=lambda x: (x[0], x[1]))
+            self.ts = array("q", [e[0] for e in events])
+            self.ops = array("q", [e[1] for e in events])
+            self.vals = [e[2] for e in events]
+            return
+        for ts, op_id, val in late:
+            lo = bisect_left(self.ts, ts)
+            idx = bisect_right(self.ts, ts, lo)
+            while idx > lo and self.ops[idx-1] > op_id:
+                idx -= 1
+            self.ts.insert(idx, ts)
+            self.ops.insert(idx, op_id)
+            self.vals.insert(idx, val)
+
+    def values(self):
+        self._merge()
+        return self.vals
+
+    def latest(self):
+        if self._late:
+            self._merge()
+        return self.vals[-1] if self.vals else None
+
+    def last_ts(self):
+        if self._late:
+            self._merge()
+        return self.ts[-1] if self.ts else None
+
+    def between(self, start, end):
+        '''(ts, op_id, val) events with start <= ts <= end, in order'''
+        self._merge()
+        lo = bisect_left(self.ts, start)
+        hi = bisect_right(self.ts, end, lo)
+        return zip(self.ts[lo:hi], self.ops[lo:hi], self.vals[lo:hi])
 
     def get_at(self, ts):
+        self._merge()
         if ts is None: # get latest:
-            return self.events[-1][-1] if self.events else None
-        idx = bisect_right(self.events, (ts, float("inf"), None), key=self._key) - 1
-        return self.events[idx][-1]
+            return self.vals[-1] if self.vals else None
+        idx = bisect_right(self.ts, ts) - 1
+        return self.vals[idx] if idx >= 0 else None
 
     def rollback(self, ts):
-        idx = bisect_right(self.events, (ts, float("inf"), None), key=self._key)
-        self.events = self.events[:idx]
+        self._merge()
+        idx = bisect_right(self.ts, ts)
+        del self.ts[idx:]
+        del self.ops[idx:]
+        del self.vals[idx:]
 
-@dataclass
 class Package:
-    pid: str
-    create_ts: int
-    delivered_ts: EventLog=field(default_factory=EventLog)
-    weight: EventLog=field(default_factory=EventLog)
-    destination: EventLog=field(default_factory=EventLog)
+    '''
+    a package's timelines. weight and destination hold their creation value inline until the first
+    change promotes them to an EventLog; delivered_ts stays None until the package is delivered.
+    destinations are stored as the registry's interned destination codes. epoch counts the registry
+    rollbacks already applied to the timelines
+    '''
+    __slots__ = ("pid", "create_ts", "op", "weight", "destination", "delivered_ts", "epoch")
+
+    def __init__(self, pid, create_ts, op, weight, destination):
+        self.pid = pid
+        self.create_ts = create_ts
+        self.op = op
+        self.weight = weight
+        self.destination = destination
+        self.delivered_ts = None
+        self.epoch = 0
 
     @classmethod
-    def create(cls, pid, weight, destination, create_ts):
-        p = cls(pid=pid, create_ts=create_ts)
-        op = OpSeq.next()
-        p.delivered_ts.append(create_ts, op, float("inf"))
-        p.weight.append(create_ts, op, weight)
-        p.destination.append(create_ts, op, destination)
-        return p
+    def create(cls, pid, weight, destination, create_ts, op):
+        return cls(pid, create_ts, op, weight, destination)
+
+    def _initial(self, val, ts):
+        if ts is None or self.create_ts is None or self.create_ts <= ts:
+            return val
+
+    def _promote(self, val):
+        log = EventLog()
+        log.append(self.create_ts, self.op, val)
+        return log
 
     # getters
     def get_weight(self, ts):
-        return self.weight.get_at(ts)
+        if type(self.weight) is EventLog:
+            return self.weight.get_at(ts)
+        return self._initial(self.weight, ts)
     def get_dest(self, ts):
-        return self.destination.get_at(ts)
+        if type(self.destination) is EventLog:
+            return self.destination.get_at(ts)
+        return self._initial(self.destination, ts)
     def get_deliver_time(self, ts):
-        return self.delivered_ts.get_at(ts)
+        if self.delivered_ts is None:
+            return float("inf")
+        deliver_time = self.delivered_ts.get_at(ts)
+        return float("inf") if deliver_time is None else deliver_time
+
+    def latest(self):
+        '''latest (weight, destination), or None once delivered. delivered_ts is only kept while it holds a delivery'''
+        if self.delivered_ts is not None:
+            return None
+        weight, dest = self.weight, self.destination
+        return (weight.latest() if type(weight) is EventLog else weight,
+                dest.latest() if type(dest) is EventLog else dest)
 
     # setters
-    def set_weight(self, new_weight, ts):
-        op = OpSeq.next()
+    def set_weight(self, new_weight, ts, op):
+        if type(self.weight) is not EventLog:
+            self.weight = self._promote(self.weight)
         self.weight.append(ts, op, new_weight)
-    def set_dest(self, new_dest, ts):
-        op = OpSeq.next()
+    def set_dest(self, new_dest, ts, op):
+        if type(self.destination) is not EventLog:
+            self.destination = self._promote(self.destination)
         self.destination.append(ts, op, new_dest)
-    def set_delivery_ts(self, ts):
-        op = OpSeq.next()
+    def set_delivery_ts(self, ts, op):
+        if self.delivered_ts is None:
+            self.delivered_ts = EventLog()
         self.delivered_ts.append(ts, op, ts)
-        
+    def extend(self, weights, dests, deliveries):
+        '''append runs of (ts, op, val) events to the timelines in one step each'''
+        if weights:
+            if type(self.weight) is not EventLog:
+                self.weight = self._promote(self.weight)
+            self.weight.extend(weights)
+        if dests:
+            if type(self.destination) is not EventLog:
+                self.destination = self._promote(self.destination)
+            self.destination.extend(dests)
+        if deliveries:
+            if self.delivered_ts is None:
+                self.delivered_ts = EventLog()
+            self.delivered_ts.extend(deliveries)
+
     # helpers
+    def timed(self):
+        '''whether any event of the package has a timestamp. untimed events are stored before all of them'''
+        if self.create_ts is not None:
+            return True
+        for timeline in (self.weight, self.destination, self.delivered_ts):
+            if type(timeline) is EventLog and timeline.last_ts() != EventLog._untimed:
+                return True
+        return False
+
     def exists(self, ts):
         if ts is None or self.create_ts is None:
             return True
         else:
             return self.create_ts <= ts < self.get_deliver_time(ts)
 
+    def active_until(self):
+        '''end of the interval the package is active in: its earliest delivery, or inf'''
+        if self.delivered_ts is None or self.create_ts is None:
+            return float("inf")
+        return min(self.delivered_ts.values(), default=float("inf"))
+
+    def history(self, start, end, names):
+        '''
+        generator of [ts, attribute, value] for every change in [start, end], ordered by (ts, op id). the
+        timelines are sliced when called, so later writes or rollbacks do not change what it yields
+        '''
+        streams = []
+        for name, timeline in (("weight", self.weight), ("destination", self.destination), ("delivered", self.delivered_ts)):
+            if type(timeline) is EventLog:
+                events = timeline.between(start, end)
+            elif timeline is not None and self.create_ts is not None and start <= self.create_ts <= end:
+                events = [(self.create_ts, self.op, timeline)]
+            else:
+                continue
+            streams.append(zip(events, repeat(name)))
+        return ([ts, name, names[val] if name == "destination" else val]
+                for (ts, _, val), name in heapq.merge(*streams, key=lambda e: e[0][:2]))
+
+    def events(self, name):
+        '''(ts, val) events of the "weight" or "destination" timeline in order; an inline value is one event at creation'''
+        timeline = getattr(self, name)
+        if type(timeline) is EventLog:
+            return [(ts, val) for ts, _, val in timeline]
+        return [(EventLog._untimed if self.create_ts is None else self.create_ts, timeline)]
+
+    def destinations(self):
+        if type(self.destination) is EventLog:
+            return set(self.destination.values())
+        return {self.destination}
+
+    def rollback(self, ts):
+        # logs that shrink back to their creation event are demoted to inline values
+        if self.delivered_ts is not None:
+            self.delivered_ts.rollback(ts)
+            if not self.delivered_ts:
+                self.delivered_ts = None
+        if type(self.weight) is EventLog:
+            self.weight.rollback(ts)
+            if len(self.weight) == 1:
+                self.weight = self.weight.vals[0]
+        if type(self.destination) is EventLog:
+            self.destination.rollback(ts)
+            if len(self.destination) == 1:
+                self.destination = self.destination.vals[0]
+
+class EventStore:
+    '''
+    write-ahead log of registry events plus periodic snapshots in a local directory. both files start with
+    a (magic, generation) header. the log holds records of (kind, ts, weight, tracking_id length,
+    destination length) and the utf-8 strings, written after the snapshot of its generation. a snapshot
+    holds the package state in int64 columns: per package its creation time, op id and, per timeline,
+    an event count or inline value, then the (ts, op id, value) columns of the three timelines and the
+    destination names and tracking_ids. loading it is a few array copies, so only the log is replayed
+    '''
+    CREATE, WEIGHT, REDIRECT, DELIVER, ROLLBACK = range(1, 6)
+    _methods = {CREATE: "PKG_CREATE_AT", WEIGHT: "PKG_SET_WEIGHT_AT", REDIRECT: "PKG_REDIRECT_AT",
+                DELIVER: "PKG_MARK_DELIVERED_AT", ROLLBACK: "ROLLBACK"}
+    _header = struct.Struct("<4sQ")
+    _record = struct.Struct("<BqqHH")
+    _meta = struct.Struct("<7q") # last op id, latest timestamp, destinations, packages, events per timeline
+    _untimed = -1
+
+    def __init__(self, path, snapshot_every=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.log_path = self.path / "events.wal"
+        self.snapshot_path = self.path / "registry.snap"
+        self.snapshot_every = snapshot_every # log records between snapshots; None never snapshots
+        self.generation = 0
+        self.snapshot_max = self._untimed # latest event time held by the snapshot
+        self.rec_ts = array("q") # timestamp, offset and running max timestamp of every log record
+        self.rec_off = array("q")
+        self.rec_max = array("q")
+        self.file = None
+
+    @classmethod
+    def encode(cls, kind, ts, pid="", weight=0, dest=""):
+        '''the record of an event; ValueError if it does not fit the record format'''
+        pid, dest = pid.encode(), dest.encode()
+        if len(pid) > 0xFFFF or len(dest) > 0xFFFF:
+            raise ValueError("tracking_id and destination are limited to 65535 utf-8 bytes")
+        try:
+            return cls._record.pack(kind, cls._untimed if ts is None else ts, weight, len(pid), len(dest)) + pid + dest
+        except struct.error as e: # timestamp or weight outside of int64
+            raise ValueError(str(e)) from None
+
+    @classmethod
+    def _decode(cls, buf):
+        '''yield (offset, kind, ts, pid, weight, dest) for every complete record of a mapped file'''
+        size, off = len(buf), cls._header.size
+        while off + cls._record.size <= size:
+            kind, ts, weight, pid_len, dest_len = cls._record.unpack_from(buf, off)
+            start = off + cls._record.size
+            end = start + pid_len + dest_len
+            if end > size: # torn write at the end of the log
+                return
+            pid, dest = bytes(buf[start:start+pid_len]).decode(), bytes(buf[start+pid_len:end]).decode()
+            yield off, kind, None if ts == cls._untimed else ts, pid, weight, dest
+            off = end
+
+    @classmethod
+    def _op(cls, kind, ts, pid, weight, dest):
+        args = {cls.CREATE: [ts, pid, weight, dest], cls.WEIGHT: [ts, pid, weight], cls.REDIRECT: [ts, pid, dest],
+                cls.DELIVER: [ts, pid], cls.ROLLBACK: [ts]}[kind]
+        return cls._methods[kind], args, {}
+
+    def _read(self, path, magic):
+        '''memory-map a file and return (generation, mapping), or (None, None) if it is missing'''
+        if not path.exists() or path.stat().st_size < self._header.size:
+            return None, None
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        found, generation = self._header.unpack_from(buf, 0)
+        if found != magic:
+            raise ValueError(f"{path} is not a {magic.decode()} file")
+        return generation, buf
+
+    @staticmethod
+    def _columns(buf, off, spec):
+        '''read little-endian arrays of (typecode, length) from buf at off; returns (arrays, next offset)'''
+        columns = []
+        for typecode, n in spec:
+            column = array(typecode)
+            end = off + column.itemsize * n
+            column.frombytes(buf[off:end])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            off = end
+        return columns, off
+
+    @staticmethod
+    def _strings(buf, off, lengths):
+        strings = []
+        for n in lengths:
+            strings.append(bytes(buf[off:off+n]).decode())
+            off += n
+        return strings, off
+
+    def load(self):
+        '''(last op id, destination names, packages) of the snapshot, or None if there is none. call before replay'''
+        generation, buf = self._read(self.snapshot_path, b"PKGS")
+        if buf is None:
+            return None
+        self.generation = generation
+        seq, self.snapshot_max, n_names, n_pkgs, *n_events = self._meta.unpack_from(buf, self._header.size)
+        spec = [("H", n_names), ("H", n_pkgs), ("q", n_pkgs), ("q", n_pkgs), ("q", 3 * n_pkgs), ("q", 3 * n_pkgs)]
+        (name_lens, pid_lens, create_ts, ops, counts, inline), off = self._columns(buf, self._header.size + self._meta.size, spec)
+        events, off = self._columns(buf, off, [("q", n) for n in n_events for _ in range(3)])
+        names, off = self._strings(buf, off, name_lens)
+        pids, off = self._strings(buf, off, pid_lens)
+        buf.close()
+        pkgs, starts = [], [0, 0, 0]
+        for i, pid in enumerate(pids):
+            ts = create_ts[i]
+            pkg = Package(pid, None if ts == self._untimed else ts, ops[i], None, None)
+            timelines = []
+            for k in range(3):
+                n = counts[3*i+k]
+                if not n: # inline value, or no deliveries
+                    timelines.append(None if k == 2 else inline[3*i+k])
+                    continue
+                log, lo, hi = EventLog(), starts[k], starts[k] + n
+                log.ts, log.ops, log.vals = events[3*k][lo:hi], events[3*k+1][lo:hi], events[3*k+2][lo:hi].tolist()
+                starts[k] = hi
+                timelines.append(log)
+            pkg.weight, pkg.destination, pkg.delivered_ts = timelines
+            pkgs.append(pkg)
+        return seq, names, pkgs
+
+    def replay(self):
+        '''yield (method, args, kwargs) for the log records written after the snapshot'''
+        log_gen, log = self._read(self.log_path, b"PKGW")
+        self.generation = max(self.generation, log_gen or 0)
+        end = self._header.size
+        if log is not None:
+            if log_gen == self.generation: # an older log was already folded into the snapshot
+                for off, kind, ts, pid, weight, dest in self._decode(log):
+                    self._track(off, ts)
+                    end = off + self._record.size + len(pid.encode()) + len(dest.encode())
+                    yield self._op(kind, ts, pid, weight, dest)
+            log.close()
+        if log_gen != self.generation:
+            self._reset_log()
+        else:
+            with open(self.log_path, "r+b") as f: # drop a torn record left by a crash
+                f.truncate(end)
+        self.file = open(self.log_path, "ab")
+
+    def _track(self, off, ts):
+        ts = self._untimed if ts is None else ts
+        self.rec_ts.append(ts)
+        self.rec_off.append(off)
+        self.rec_max.append(max(ts, self.rec_max[-1]) if self.rec_max else ts)
+
+    def _reset_log(self):
+        tmp = self.log_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(self._header.pack(b"PKGW", self.generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.log_path)
+        del self.rec_ts[:], self.rec_off[:], self.rec_max[:]
+
+    def append(self, kind, ts, pid="", weight=0, dest=""):
+        self.write(ts, self.encode(kind, ts, pid, weight, dest))
+
+    def write(self, ts, record):
+        '''append an encoded record'''
+        self._track(self.file.tell(), ts)
+        self.file.write(record)
+
+    def flush(self):
+        self.file.flush()
+
+    def snapshot_due(self):
+        return self.snapshot_every is not None and len(self.rec_ts) >= self.snapshot_every
+
+    def snapshot(self, seq, names, pkgs):
+        '''write the packages as the new snapshot, then start the next generation's log'''
+        self.file.close()
+        self.generation += 1
+        create_ts, ops, counts, inline = array("q"), array("q"), array("q"), array("q")
+        events = [array("q") for _ in range(9)] # ts, op id and value columns of weight, destination, delivered_ts
+        pids = []
+        for pkg in pkgs:
+            pids.append(pkg.pid.encode())
+            create_ts.append(self._untimed if pkg.create_ts is None else pkg.create_ts)
+            ops.append(pkg.op)
+            for k, timeline in enumerate((pkg.weight, pkg.destination, pkg.delivered_ts)):
+                if type(timeline) is EventLog:
+                    timeline._merge()
+                    counts.append(len(timeline.vals))
+                    inline.append(0)
+                    events[3*k].extend(timeline.ts)
+                    events[3*k+1].extend(timeline.ops)
+                    events[3*k+2].extend(timeline.vals)
+                else:
+                    counts.append(0)
+                    inline.append(0 if timeline is None else timeline)
+        names = [name.encode() for name in names]
+        self.snapshot_max = max([max(column, default=self._untimed) for column in (create_ts, *events[::3])])
+        meta = self._meta.pack(seq, self.snapshot_max, len(names), len(pids), *(len(column) for column in events[::3]))
+        tmp = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(self._header.pack(b"PKGS", self.generation))
+            f.write(meta)
+            for column in [array("H", map(len, names)), array("H", map(len, pids)), create_ts, ops, counts, inline, *events]:
+                if sys.byteorder == "big":
+                    column.byteswap()
+                column.tofile(f)
+            f.write(b"".join(names))
+            f.write(b"".join(pids))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self._reset_log()
+        self.file = open(self.log_path, "ab")
+
     def rollback(self, ts):
-        self.delivered_ts.rollback(ts)
-        self.weight.rollback(ts)
-        self.destination.rollback(ts)
+        '''truncate the log when every event after ts is in its tail; otherwise log the rollback'''
+        idx = len(self.rec_ts)
+        while idx and self.rec_ts[idx-1] > ts:
+            idx -= 1
+        kept = max(self.snapshot_max, self.rec_max[idx-1] if idx else self._untimed)
+        if kept > ts: # the snapshot or an earlier record still holds events after ts
+            self.append(self.ROLLBACK, ts)
+        elif idx < len(self.rec_ts):
+            self.file.flush()
+            self.file.truncate(self.rec_off[idx])
+            self.file.seek(self.rec_off[idx]) # truncate keeps the old position, which append offsets rely on
+            del self.rec_ts[idx:], self.rec_off[idx:], self.rec_max[idx:]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 class Answer:
-    def __init__(self):
+    # methods that neither read nor rebuild the query indices, so run_batch can defer index updates across them
+    _index_free = frozenset({"PKG_CREATE", "PKG_SET_WEIGHT", "PKG_REDIRECT", "PKG_GET", "PKG_CREATE_AT",
+                             "PKG_SET_WEIGHT_AT", "PKG_REDIRECT_AT", "PKG_MARK_DELIVERED_AT", "PKG_GET_AT",
+                             "PKG_LIST_BY_DEST_AT"})
+    # positional arity of the timestamped writes run_batch ingests in bulk
+    _bulk = {"PKG_CREATE_AT": 4, "PKG_SET_WEIGHT_AT": 3, "PKG_REDIRECT_AT": 3, "PKG_MARK_DELIVERED_AT": 2}
+
+    def __init__(self, checkpoint_every=64, cache_size=4096, data_dir=None, snapshot_every=None, lazy_rollback=False):
         self.pkgs = {}
+        self.seq = OpSeq()
+        self.cache = OrderedDict() # (tracking_id, timestamp) -> PKG_GET_AT result, least recently used first
+        self.cache_size = cache_size
+        self.cached_ts = defaultdict(set) # tracking_id -> timestamps it has cached results for
+        self.cache_hits, self.cache_misses = 0, 0
+        self.pending = None # tracking_id -> view before the first deferred write, while run_batch is active
+        self.journal = {} # ts -> tracking_ids changed at ts, for timestamps after the last checkpoint
+        self.journal_ts = SortedKeys()
+        self.checkpoint_every = checkpoint_every # journal timestamps folded per checkpoint; None keeps every one
+        self.checkpoints = [] # ascending checkpoint timestamps
+        self.checkpoint_pids = [] # tracking_ids changed between the previous checkpoint and this one
+        self.dest_ids = {} # destination -> interned code stored in events and indices
+        self.dest_names = [] # code -> destination
+        self.by_dest = defaultdict(SortedKeys) # destination code -> live tracking_ids
+        self.dest_seen = defaultdict(set) # destination code -> tracking_ids that were ever sent there
+        self.active = IntervalIndex() # [create_ts, delivery) interval of every package
+        self.ranking = SortedKeys() # (-weight, tracking_id) of live packages
+        self.count, self.total_weight = 0, 0 # running totals over live packages
+        self.dest_totals = defaultdict(lambda: [0, 0]) # destination code -> [count, total weight]
+        self.lazy_rollback = lazy_rollback # ROLLBACK only records its cutoff; packages are truncated when next touched
+        self.epoch = 0 # lazy rollbacks so far
+        self.cutoffs = [] # cutoff of every lazy rollback, by epoch
+        self.unsettled = [] # cutoffs of lazy rollbacks not yet popped from the journal
+        self.stale = set() # tracking_ids the popped journal entries name, until they are truncated
+        self.store = None # EventStore persisting every write, when a data_dir is given
+        if data_dir is not None:
+            store = EventStore(data_dir, snapshot_every)
+            collecting = gc.isenabled()
+            gc.disable() # loading allocates a few objects per package and event, none of them garbage
+            try:
+                state = store.load()
+                if state is not None:
+                    self._restore(*state)
+            finally:
+                if collecting:
+                    gc.enable()
+            for result in self.run_batch(store.replay()):
+                if isinstance(result, Exception):
+                    raise result
+            self.store = store
 
     def run(self, method: str, *args, **kwargs): # do not edit this method
         return getattr(self, method)(*args, **kwargs)
 
+    def run_batch(self, ops):
+        '''
+        run a sequence of (method, args, kwargs) operations in order and return their results, with any
+        raised exception returned in place of its result. consecutive timestamped writes are ingested in
+        bulk by _ingest. index updates are deferred and applied once per touched package before the next
+        index read
+        '''
+        dispatch, results, writes = {}, [], []
+        self.pending = {}
+        try:
+            for method, args, kwargs in ops:
+                arity = self._bulk.get(method)
+                if (arity is not None and not kwargs and len(args) == arity and type(args[0]) is int
+                        and type(args[1]) is str and None not in args):
+                    writes.append((len(results), method, args))
+                    results.append(None)
+                    continue
+                if writes:
+                    self._ingest(writes, results)
+                    writes = []
+                try:
+                    fn = dispatch.get(method)
+                    if fn is None:
+                        fn = dispatch[method] = getattr(self, method)
+                    if self.pending and method not in self._index_free:
+                        self._flush()
+                    results.append(fn(*args, **kwargs))
+                except Exception as e:
+                    results.append(e)
+            if writes:
+                self._ingest(writes, results)
+        finally:
+            self._flush()
+            self.pending = None
+            if self.store is not None:
+                self.store.flush()
+        return results
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def log_lengths(self):
+        '''yield (timeline, events) for every package timeline; inline values count as one event'''
+        self.compact()
+        for pkg in self.pkgs.values():
+            for name, timeline in (("weight", pkg.weight), ("destination", pkg.destination), ("delivered", pkg.delivered_ts)):
+                if type(timeline) is EventLog:
+                    yield name, len(timeline)
+                elif timeline is not None:
+                    yield name, 1
+
+    def _ingest(self, writes, results):
+        '''
+        apply a run of (position, method, args) timestamped writes with the results of running them one at a time.
+        writes to different packages are independent, so each package's writes are validated in order against its
+        created/delivered interval, the accepted ones are logged in run order, and each package then gets one
+        sorted append per timeline, one cache invalidation, its journal entries and one deferred reindex
+        '''
+        groups = defaultdict(list)
+        for write in writes:
+            groups[write[2][1]].append(write)
+        store, encode, inf = self.store, EventStore.encode, float("inf")
+        accepted, records = [], []
+        for pid, group in groups.items():
+            pkg = self._resolve(pid)
+            alive = pkg is not None
+            create_ts, until = (pkg.create_ts, pkg.active_until()) if alive else (None, inf)
+            events = []
+            for pos, method, args in group:
+                ts = args[0]
+                try:
+                    # the checks of the *_AT methods, in their order
+                    if ts < 0:
+                        raise ValueError
+                    weight, destination = 0, ""
+                    if method == "PKG_CREATE_AT":
+                        kind, weight, destination = EventStore.CREATE, args[2], args[3]
+                        if alive or not pid:
+                            raise ValueError
+                        if weight < 0 or not isinstance(weight, int) or not destination:
+                            raise ValueError
+                    else:
+                        if not alive or not (create_ts is None or create_ts <= ts < until):
+                            raise KeyError
+                        if method == "PKG_SET_WEIGHT_AT":
+                            kind, weight = EventStore.WEIGHT, args[2]
+                            if weight < 0 or not isinstance(weight, int):
+                                raise ValueError
+                        elif method == "PKG_REDIRECT_AT":
+                            kind, destination = EventStore.REDIRECT, args[2]
+                            if not destination:
+                                raise ValueError
+                        else:
+                            kind = EventStore.DELIVER
+                    if store is not None:
+                        records.append((pos, ts, encode(kind, ts, pid, weight, destination)))
+                except Exception as e:
+                    results[pos] = e
+                    continue
+                if kind == EventStore.CREATE:
+                    alive, create_ts = True, ts
+                elif kind == EventStore.DELIVER and ts < until:
+                    until = ts
+                events.append((kind, ts, weight, destination))
+            if events:
+                accepted.append((pid, pkg, events))
+
+        if records: # logged before anything is applied, in the order the writes were made
+            records.sort(key=lambda r: r[0])
+            for _, ts, record in records:
+                store.write(ts, record)
+
+        for pid, pkg, events in accepted:
+            self._before(pid, pkg)
+            created, weights, dests, deliveries = pkg is None, [], [], []
+            for kind, ts, weight, destination in events:
+                op = self.seq.next()
+                if kind == EventStore.WEIGHT:
+                    weights.append((ts, op, weight))
+                elif kind == EventStore.REDIRECT:
+                    dest = self._intern(destination)
+                    dests.append((ts, op, dest))
+                    self.dest_seen[dest].add(pid)
+                elif kind == EventStore.DELIVER:
+                    deliveries.append((ts, op, ts))
+                else:
+                    dest = self._intern(destination)
+                    pkg = self.pkgs[pid] = Package.create(pid=pid, weight=weight, destination=dest, create_ts=ts, op=op)
+                    pkg.epoch = self.epoch
+                    self.dest_seen[dest].add(pid)
+            pkg.extend(weights, dests, deliveries)
+            if created:
+                self.active.add(pid, self._start(pkg), pkg.active_until())
+            elif deliveries:
+                self.active.update(pid, self._start(pkg), pkg.active_until())
+            stamps = {event[1] for event in events}
+            self._invalidate(pid, min(stamps))
+            for ts in stamps:
+                self._journal(ts, pid)
+        self._snapshot()
+
     def pkg_exists(self, pid, ts):
-        return pid in self.pkgs and self.pkgs[pid].exists(ts)
-
-    def _checks(self, old_pid=None, new_pid=None, tracking_id=None, weight=None, destination=None, ts=None):
-        if ts is not None:
-            if ts < 0:
-                raise ValueError
-        if old_pid is not None:
-            if not self.pkg_exists(old_pid, ts):
-                raise KeyError
-        if new_pid is not None:
-            if new_pid in self.pkgs:
-                raise ValueError
-        if tracking_id is not None:
-            if not tracking_id:
-                raise ValueError
-        if weight is not None:
-            if weight<0 or not isinstance(weight, int):
-                raise ValueError
-        if destination is not None:
-            if not destination:
-                raise ValueError
+        pkg = self._resolve(pid)
+        return pkg is not None and pkg.exists(ts)
+
+    # lazy rollback
+    def _resolve(self, pid):
+        '''the package with every rollback applied, or None if it does not exist (anymore)'''
+        pkg = self.pkgs.get(pid)
+        if pkg is None or pkg.epoch == self.epoch:
+            return pkg
+        if self.unsettled:
+            self._settle()
+        if pid not in self.stale: # no journaled event of the package is after a cutoff, so there is nothing to drop
+            pkg.epoch = self.epoch
+            return pkg
+        self.stale.discard(pid)
+        return self._truncate(pid, pkg)
+
+    def _truncate(self, pid, pkg):
+        '''apply the rollbacks the package has not seen yet'''
+        cutoff = min(self.cutoffs[pkg.epoch:])
+        pkg.epoch = self.epoch
+        self._rollback_pkg(pid, pkg, cutoff)
+        return self.pkgs.get(pid)
+
+    def _settle(self):
+        '''pop the journal entries of lazy rollbacks into stale, before a package is resolved or a new write is journaled'''
+        for cutoff in self.unsettled:
+            self.stale |= self._changed_after(cutoff)
+        self.unsettled.clear()
+
+    def compact(self):
+        '''apply pending lazy rollbacks to every package they affect, so the indices reflect them'''
+        if self.unsettled:
+            self._settle()
+        while self.stale:
+            pid = self.stale.pop()
+            pkg = self.pkgs.get(pid)
+            if pkg is not None and pkg.epoch != self.epoch:
+                self._truncate(pid, pkg)
+
+    def _rollback_pkg(self, pid, pkg, timestamp):
+        old, dests = pkg.latest(), pkg.destinations()
+        if pkg.create_ts is not None and pkg.create_ts > timestamp:
+            self.pkgs.pop(pid)
+            self.active.discard(pid, self._start(pkg))
+            new, kept = None, set()
+        else:
+            pkg.rollback(timestamp)
+            self.active.update(pid, self._start(pkg), pkg.active_until())
+            new, kept = pkg.latest(), pkg.destinations()
+        for dest in dests - kept:
+            self.dest_seen[dest].discard(pid)
+            if not self.dest_seen[dest]:
+                del self.dest_seen[dest]
+        self._reindex(pid, old, new)
+
+    # index maintenance
+    def _start(self, pkg):
+        return EventLog._untimed if pkg.create_ts is None else pkg.create_ts
+
+    def _before(self, pid, pkg):
+        if self.pending is None:
+            return pkg.latest() if pkg is not None else None
+        if pid not in self.pending:
+            self.pending[pid] = pkg.latest() if pkg is not None else None
+
+    def _after(self, pid, pkg, old):
+        if self.pending is None:
+            self._reindex(pid, old, pkg.latest())
+
+    def _flush(self):
+        pending, self.pending = self.pending, {}
+        for pid, old in pending.items():
+            pkg = self.pkgs.get(pid)
+            self._reindex(pid, old, pkg.latest() if pkg is not None else None)
+
+    def _reindex(self, pid, old, new):
+        if old == new:
+            return
+        old_weight, old_dest = old or (None, None)
+        new_weight, new_dest = new or (None, None)
+        if old_dest != new_dest: # only touch the orderings whose key changed
+            if old is not None:
+                pids = self.by_dest[old_dest]
+                pids.discard(pid)
+                if not pids:
+                    del self.by_dest[old_dest]
+            if new is not None:
+                self.by_dest[new_dest].add(pid)
+        if old_weight != new_weight:
+            if old is not None:
+                self.ranking.discard((-old_weight, pid))
+            if new is not None:
+                self.ranking.add((-new_weight, pid))
+        if old is not None:
+            self.count -= 1
+            self.total_weight -= old_weight
+            totals = self.dest_totals[old_dest]
+            totals[0] -= 1
+            totals[1] -= old_weight
+            if not totals[0]:
+                del self.dest_totals[old_dest]
+        if new is not None:
+            self.count += 1
+            self.total_weight += new_weight
+            totals = self.dest_totals[new_dest]
+            totals[0] += 1
+            totals[1] += new_weight
+
+    # change journal
+    def _journal(self, ts, pid):
+        if ts is None: # untimed events can never be rolled back
+            return
+        if self.unsettled:
+            self._settle()
+        if self.checkpoints and ts <= self.checkpoints[-1]:
+            self.checkpoint_pids[bisect_left(self.checkpoints, ts)].add(pid)
+            return
+        if ts not in self.journal:
+            self.journal[ts] = set()
+            self.journal_ts.add(ts)
+        self.journal[ts].add(pid)
+        if self.checkpoint_every and len(self.journal) >= 2 * self.checkpoint_every:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        '''fold the oldest journal timestamps into a single checkpoint interval'''
+        cutoff = self.journal_ts.head(self.checkpoint_every)[-1]
+        pids = set()
+        for ts in self.journal_ts.pop_until(cutoff):
+            pids |= self.journal.pop(ts)
+        self.checkpoints.append(cutoff)
+        self.checkpoint_pids.append(pids)
+
+    def _changed_after(self, ts):
+        '''pop every journal entry after ts and return the tracking_ids they name (possibly a superset)'''
+        pids = set()
+        k = bisect_right(self.checkpoints, ts)
+        if k < len(self.checkpoints): # the checkpoint interval holding ts is kept, ending at ts
+            for changed in self.checkpoint_pids[k:]:
+                pids |= changed
+            self.checkpoints[k:] = [ts]
+            self.checkpoint_pids[k+1:] = []
+        for t in self.journal_ts.pop_after(ts):
+            pids |= self.journal.pop(t)
+        return pids
+
+    # persistence
+    def _log(self, kind, ts, pid="", weight=0, dest=""):
+        '''append a validated write to the store before it is applied, so a record that fails leaves the registry untouched'''
+        if self.store is None:
+            return
+        self.store.append(kind, ts, pid, weight, dest)
+        if self.pending is None: # run_batch flushes once at the end
+            self.store.flush()
+
+    def _snapshot(self):
+        '''snapshot the registry once the logged write is applied, if one is due'''
+        if self.store is not None and self.store.snapshot_due():
+            self.compact()
+            self.store.snapshot(self.seq.last(), self.dest_names, self.pkgs.values())
+
+    def _restore(self, seq, names, pkgs):
+        '''load the packages of a snapshot into the empty registry, building the indices and journal in bulk'''
+        self.seq = OpSeq(seq)
+        self.dest_names = names
+        self.dest_ids = {name: code for code, name in enumerate(names)}
+        live, intervals, changes = [], [], []
+        for pkg in pkgs:
+            pid = pkg.pid
+            self.pkgs[pid] = pkg
+            view = pkg.latest()
+            if view is not None:
+                live.append((pid, *view))
+            intervals.append((self._start(pkg), pid, pkg.active_until()))
+            for dest in pkg.destinations():
+                self.dest_seen[dest].add(pid)
+            if pkg.create_ts is not None:
+                changes.append((pkg.create_ts, pid))
+            for timeline in (pkg.weight, pkg.destination, pkg.delivered_ts):
+                if type(timeline) is EventLog:
+                    changes.extend(zip(timeline.ts, repeat(pid)))
+
+        self.active = IntervalIndex.from_sorted(sorted(intervals))
+        self.ranking = SortedKeys.from_sorted(sorted((-weight, pid) for pid, weight, _ in live))
+        by_dest = defaultdict(list)
+        for pid, weight, dest in live:
+            by_dest[dest].append(pid)
+            totals = self.dest_totals[dest]
+            totals[0] += 1
+            totals[1] += weight
+        for dest, pids in by_dest.items():
+            self.by_dest[dest] = SortedKeys.from_sorted(sorted(pids))
+        self.count, self.total_weight = len(live), sum(weight for _, weight, _ in live)
+
+        # the journal as the writes would have left it: checkpoints of checkpoint_every timestamps, then the rest.
+        # untimed events can never be rolled back, so they are not journaled
+        changes.sort()
+        lo = bisect_right(changes, EventLog._untimed, key=itemgetter(0))
+        ordered = sorted({ts for ts, _ in changes[lo:]})
+        k = 0
+        if self.checkpoint_every:
+            while len(ordered) - k >= 2 * self.checkpoint_every:
+                k += self.checkpoint_every
+                hi = bisect_right(changes, ordered[k-1], lo, key=itemgetter(0))
+                self.checkpoints.append(ordered[k-1])
+                self.checkpoint_pids.append(set(map(itemgetter(1), changes[lo:hi])))
+                lo = hi
+        for ts, pid in changes[lo:]:
+            self.journal.setdefault(ts, set()).add(pid)
+        self.journal_ts = SortedKeys.from_sorted(ordered[k:])
+
+    # read cache
+    def _invalidate(self, pid, ts):
+        '''drop the cached reads of a package at or after ts (every read if ts is None)'''
+        cached = self.cached_ts.get(pid)
+        if not cached:
+            return
+        stale = cached if ts is None else [t for t in cached if t >= ts]
+        for t in stale:
+            del self.cache[(pid, t)]
+        if len(stale) == len(cached):
+            del self.cached_ts[pid]
+        else:
+            cached.difference_update(stale)
+
+    def _clear_cache(self):
+        self.cache.clear()
+        self.cached_ts.clear()
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.cache), "max_size": self.cache_size}
+
+    # validation. public methods inline the checks their spec lists, so no call runs a generic keyword-argument chain.
+    # like the checks they replaced, arguments that are None are not validated
+    def _live(self, pid, ts):
+        '''the package if it exists as of ts, otherwise KeyError'''
+        pkg = self._resolve(pid)
+        if pkg is None or not pkg.exists(ts):
+            raise KeyError
+        return pkg
+
+    # writes. the public methods validate, then one of these logs and applies the change
+    def _create(self, timestamp, tracking_id, weight, destination):
+        self._log(EventStore.CREATE, timestamp, tracking_id, weight, destination)
+        dest = self._intern(destination)
+        pkg = self.pkgs[tracking_id] = Package.create(pid=tracking_id, weight=weight, destination=dest, create_ts=timestamp, op=self.seq.next())
+        pkg.epoch = self.epoch
+        self.dest_seen[dest].add(tracking_id)
+        self.active.add(tracking_id, self._start(pkg), float("inf"))
+        self._invalidate(tracking_id, timestamp)
+        self._journal(timestamp, tracking_id)
+        self._after(tracking_id, pkg, self._before(tracking_id, None))
+        self._snapshot()
+
+    def _set_weight(self, timestamp, tracking_id, pkg, weight):
+        self._log(EventStore.WEIGHT, timestamp, tracking_id, weight=weight)
+        old = self._before(tracking_id, pkg)
+        pkg.set_weight(weight, timestamp, self.seq.next())
+        self._journal(timestamp, tracking_id)
+        self._invalidate(tracking_id, timestamp)
+        self._after(tracking_id, pkg, old)
+        self._snapshot()
+
+    def _redirect(self, timestamp, tracking_id, pkg, destination):
+        self._log(EventStore.REDIRECT, timestamp, tracking_id, dest=destination)
+        dest = self._intern(destination)
+        old = self._before(tracking_id, pkg)
+        pkg.set_dest(dest, timestamp, self.seq.next())
+        self._journal(timestamp, tracking_id)
+        self._invalidate(tracking_id, timestamp)
+        self.dest_seen[dest].add(tracking_id)
+        self._after(tracking_id, pkg, old)
+        self._snapshot()
+
+    def _intern(self, destination):
+        code = self.dest_ids.get(destination)
+        if code is None:
+            code = self.dest_ids[destination] = len(self.dest_names)
+            self.dest_names.append(destination)
+        return code
 
     # ---------------------- level1
     def PKG_CREATE(self, tracking_id: str, weight: int, destination: str):
@@ -116,7 +1203,15 @@ class Answer:
         raises:         ValueError          if tracking_id already exists, or if any parameter is invalid
         notes:          Store only the latest state per tracking_id. This method must not overwrite existing records.
         '''
-        self.PKG_CREATE_AT(None, tracking_id, weight, destination)
+        if self._resolve(tracking_id) is not None:
+            raise ValueError
+        if tracking_id is not None and not tracking_id:
+            raise ValueError
+        if weight is not None and (weight < 0 or not isinstance(weight, int)):
+            raise ValueError
+        if destination is not None and not destination:
+            raise ValueError
+        self._create(None, tracking_id, weight, destination)
 
     def PKG_GET(self, tracking_id: str):
         '''
@@ -126,7 +1221,7 @@ class Answer:
         raises:         None
         notes:          The return type is a 2-element list to ensure a deterministic order for tests.
         '''
-        return self.PKG_GET_AT(None, tracking_id)
+        return self._get_at(None, tracking_id) # latest state reads skip the timed path entirely
 
     def PKG_SET_WEIGHT(self, tracking_id: str, weight: int):
         '''
@@ -135,10 +1230,18 @@ class Answer:
                         weight (int):       new weight in grams; must be >= 0
         returns:        None
         raises:         KeyError            if tracking_id does not exist
-                        ValueError          if weight is invalid (< 0)
-        notes:          No rounding; accept only integers.
+                        ValueError          if weight is invalid (< 0), or the package has timestamped events
+        notes:          No rounding; accept only integers. Packages with timestamped events take PKG_SET_WEIGHT_AT,
+                        since an untimed change would be ordered before all of their events.
         '''
-        self.PKG_SET_WEIGHT_AT(None, tracking_id, weight)
+        pkg = self._resolve(tracking_id) if tracking_id is not None else None
+        if weight is not None and (weight < 0 or not isinstance(weight, int)):
+            raise ValueError
+        if pkg is None:
+            raise KeyError
+        if pkg.timed():
+            raise ValueError
+        self._set_weight(None, tracking_id, pkg, weight)
 
     def PKG_REDIRECT(self, tracking_id: str, destination: str):
         '''
@@ -147,10 +1250,18 @@ class Answer:
                         destination (str):  non-empty destination string
         returns:        None
         raises:         KeyError            if tracking_id does not exist
-                        ValueError          if destination is empty
-        notes:          Destination comparisons are case-sensitive; store exactly as provided.
+                        ValueError          if destination is empty, or the package has timestamped events
+        notes:          Destination comparisons are case-sensitive; store exactly as provided. Packages with
+                        timestamped events take PKG_REDIRECT_AT, like PKG_SET_WEIGHT.
         '''
-        self.PKG_REDIRECT_AT(None, tracking_id, destination)
+        pkg = self._resolve(tracking_id) if tracking_id is not None else None
+        if destination is not None and not destination:
+            raise ValueError
+        if pkg is None:
+            raise KeyError
+        if pkg.timed():
+            raise ValueError
+        self._redirect(None, tracking_id, pkg, destination)
 
     def PKG_LIST_BY_DEST(self, destination: str):
         '''
@@ -160,8 +1271,10 @@ class Answer:
         raises:         ValueError          if destination is empty
         notes:          Return [] if no packages match.
         '''
-        self._checks(destination=destination)
-        return sorted([pkg for pkg in self.pkgs if self.pkgs[pkg].get_dest(None)==destination])
+        if destination is not None and not destination:
+            raise ValueError
+        self.compact()
+        return list(self.by_dest.get(self.dest_ids.get(destination), ()))
 
     # ----------------------------- level 2
 
@@ -174,11 +1287,11 @@ class Answer:
         raises:         ValueError          if n < 0
         notes:          If n > number of packages, return all of them.
         '''
-        self._checks(weight=n) # same reqs as weight
-        found = []
-        for pkg in self.pkgs.values():
-            insort(found, [pkg.pid, pkg.get_weight(None), pkg.get_dest(None)], key=lambda x: (-x[1], x[2]))
-        return found[:n]
+        if n is not None and (n < 0 or not isinstance(n, int)): # same reqs as weight
+            raise ValueError
+        self.compact()
+        names = self.dest_names
+        return [[pid, -neg_weight, names[self.pkgs[pid].get_dest(None)]] for neg_weight, pid in self.ranking.head(n)]
 
 
     def PKG_AVG_WEIGHT(self):
@@ -189,10 +1302,45 @@ class Answer:
         raises:         None
         notes:          Division must be float division; round to 2 decimal places.
         '''
-        
-        count = len(self.pkgs)
-        tot = sum(pkg.get_weight(None) for pkg in self.pkgs.values())
-        return round(tot/count, 2) if count else None
+        self.compact()
+        return round(self.total_weight/self.count, 2) if self.count else None
+
+    def PKG_AVG_WEIGHT_BY_DEST(self, destination: str):
+        '''
+        description:    Calculate the average weight of all packages going to a given destination.
+        params:         destination (str):  non-empty destination string
+        returns:        float | None:       average weight (float) if packages match; None otherwise
+        raises:         ValueError          if destination is empty
+        notes:          Division must be float division; round to 2 decimal places.
+        '''
+        if destination is not None and not destination:
+            raise ValueError
+        self.compact()
+        code = self.dest_ids.get(destination)
+        if code not in self.dest_totals:
+            return None
+        count, tot = self.dest_totals[code]
+        return round(tot/count, 2)
+
+    def PKG_TOTAL_WEIGHT(self):
+        '''
+        description:    Calculate the total weight of all packages.
+        params:         none
+        returns:        int:                sum of all package weights; 0 if registry empty
+        raises:         None
+        '''
+        self.compact()
+        return self.total_weight
+
+    def PKG_COUNT(self):
+        '''
+        description:    Count the packages currently in the registry.
+        params:         none
+        returns:        int:                number of packages that have not been delivered
+        raises:         None
+        '''
+        self.compact()
+        return self.count
 
     # -------------------------- level 3
 
@@ -209,8 +1357,17 @@ class Answer:
         notes:          Each tracking_id can be created at most once (across all times).
                         Creation does not guarantee visibility at earlier times (e.g., querying before creation returns None).
         '''
-        self._checks(new_pid=tracking_id, tracking_id=tracking_id, weight=weight, destination=destination, ts=timestamp)
-        self.pkgs[tracking_id] = Package.create(pid=tracking_id, weight=weight, destination=destination, create_ts=timestamp)
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        if self._resolve(tracking_id) is not None:
+            raise ValueError
+        if tracking_id is not None and not tracking_id:
+            raise ValueError
+        if weight is not None and (weight < 0 or not isinstance(weight, int)):
+            raise ValueError
+        if destination is not None and not destination:
+            raise ValueError
+        self._create(timestamp, tracking_id, weight, destination)
 
     def PKG_SET_WEIGHT_AT(self, timestamp: int, tracking_id: str, weight: int):
         '''
@@ -224,8 +1381,16 @@ class Answer:
         notes:          Events may be added out of order relative to other events. They still affect queries
                         for times on/after their timestamps but never before creation.
         '''
-        self._checks(old_pid=tracking_id, weight=weight, ts=timestamp)
-        self.pkgs[tracking_id].set_weight(weight, timestamp)
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        pkg = self._live(tracking_id, timestamp) if tracking_id is not None else None
+        if weight is not None and (weight < 0 or not isinstance(weight, int)):
+            raise ValueError
+        if pkg is None:
+            raise KeyError
+        if timestamp is None and pkg.timed(): # it would sort before the timed events and never be seen
+            raise ValueError
+        self._set_weight(timestamp, tracking_id, pkg, weight)
 
     def PKG_REDIRECT_AT(self, timestamp: int, tracking_id: str, destination: str):
         '''
@@ -238,8 +1403,16 @@ class Answer:
                         KeyError            if tracking_id has not been created
         notes:          Destination strings are case-sensitive; store exactly as provided.
         '''
-        self._checks(old_pid=tracking_id, destination=destination, ts=timestamp)
-        self.pkgs[tracking_id].set_dest(destination, timestamp)
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        pkg = self._live(tracking_id, timestamp) if tracking_id is not None else None
+        if destination is not None and not destination:
+            raise ValueError
+        if pkg is None:
+            raise KeyError
+        if timestamp is None and pkg.timed():
+            raise ValueError
+        self._redirect(timestamp, tracking_id, pkg, destination)
 
     def PKG_MARK_DELIVERED_AT(self, timestamp: int, tracking_id: str):
         '''
@@ -252,8 +1425,17 @@ class Answer:
         notes:          For any query time t where t >= delivery timestamp, the package is considered not present.
                         Queries for t before delivery continue to reflect prior state.
         '''
-        self._checks(old_pid=tracking_id, ts=timestamp)
-        self.pkgs[tracking_id].set_delivery_ts(timestamp)
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        pkg = self._live(tracking_id, timestamp)
+        self._log(EventStore.DELIVER, timestamp, tracking_id)
+        old = self._before(tracking_id, pkg)
+        pkg.set_delivery_ts(timestamp, self.seq.next())
+        self.active.update(tracking_id, self._start(pkg), pkg.active_until())
+        self._journal(timestamp, tracking_id)
+        self._invalidate(tracking_id, timestamp)
+        self._after(tracking_id, pkg, old)
+        self._snapshot()
 
 
     def PKG_GET_AT(self, timestamp: int, tracking_id: str):
@@ -267,9 +1449,83 @@ class Answer:
         notes:          Apply the latest event at or before the timestamp for each attribute (weight, destination).
                         If multiple events share the same timestamp, apply them in insertion order.
         '''
-        self._checks(ts=timestamp)
-        if self.pkg_exists(tracking_id, timestamp):
-            return [self.pkgs[tracking_id].get_weight(timestamp), self.pkgs[tracking_id].get_dest(timestamp)]
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        if timestamp is None or not self.cache_size: # latest state reads are already O(1)
+            return self._get_at(timestamp, tracking_id)
+        key = (tracking_id, timestamp)
+        found = self.cache.get(key, self.cache)
+        if found is not self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+        else:
+            self.cache_misses += 1
+            found = self.cache[key] = self._get_at(timestamp, tracking_id)
+            self.cached_ts[tracking_id].add(timestamp)
+            if len(self.cache) > self.cache_size:
+                (pid, ts), _ = self.cache.popitem(last=False)
+                self.cached_ts[pid].discard(ts)
+                if not self.cached_ts[pid]:
+                    del self.cached_ts[pid]
+        return None if found is None else list(found)
+
+    def _get_at(self, timestamp, tracking_id):
+        pkg = self._resolve(tracking_id)
+        if pkg is not None and pkg.exists(timestamp):
+            return [pkg.get_weight(timestamp), self.dest_names[pkg.get_dest(timestamp)]]
+
+    def PKG_LIST_BY_DEST_AT(self, timestamp: int, destination: str):
+        '''
+        description:    Retrieve all tracking_ids for packages going to a given destination as of the specified timestamp.
+        params:         timestamp (int):    query time in seconds; must be >= 0
+                        destination (str):  non-empty destination string
+        returns:        list[str]:          list of tracking_ids sorted in ascending order
+        raises:         ValueError          if timestamp < 0 or destination is empty
+        notes:          Only packages that existed and were not delivered as of timestamp are included.
+                        Return [] if no packages match.
+        '''
+        if (timestamp is not None and timestamp < 0) or (destination is not None and not destination):
+            raise ValueError
+        self.compact()
+        code = self.dest_ids.get(destination)
+        return sorted(pid for pid in self.dest_seen.get(code, ())
+                        if self.pkg_exists(pid, timestamp) and self.pkgs[pid].get_dest(timestamp) == code)
+
+    def PKG_HISTORY(self, tracking_id: str, start_ts: int, end_ts: int):
+        '''
+        description:    Stream every recorded change of a package between two timestamps.
+        params:         tracking_id (str):  must refer to an existing (created) package id
+                        start_ts (int):     start of the range in seconds (inclusive); must be >= 0
+                        end_ts (int):       end of the range in seconds (inclusive); must be >= start_ts
+        returns:        generator[list]:    [timestamp (int), attribute (str), value] per change, where attribute is
+                                            "weight", "destination" or "delivered" (value is the delivery timestamp)
+        raises:         ValueError          if start_ts < 0 or end_ts < start_ts
+                        KeyError            if tracking_id has not been created
+        notes:          Changes are ordered by timestamp; changes sharing a timestamp are in insertion order.
+                        Creation appears as a weight and a destination change at the creation timestamp.
+        '''
+        if (start_ts is not None and start_ts < 0) or (start_ts is not None and end_ts is not None and end_ts < start_ts):
+            raise ValueError
+        pkg = self._resolve(tracking_id)
+        if pkg is None:
+            raise KeyError
+        # a None bound leaves that end of the range open
+        return pkg.history(EventLog._untimed if start_ts is None else start_ts, float("inf") if end_ts is None else end_ts,
+                           self.dest_names)
+
+    def PKG_LIST_ACTIVE_AT(self, timestamp: int):
+        '''
+        description:    Stream the tracking_ids of all packages that existed and were not delivered as of the timestamp.
+        params:         timestamp (int):    query time in seconds; must be >= 0
+        returns:        generator[str]:     tracking_ids ordered by creation timestamp, then tracking_id ascending
+        raises:         ValueError          if timestamp < 0
+        notes:          The matching tracking_ids are collected when called, so later events do not change the result.
+        '''
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        self.compact()
+        active = list(self.active.stab(timestamp))
+        return (pid for pid in active)
 
     # -----------------------------------------------level4
     def ROLLBACK(self, timestamp: int):
@@ -283,9 +1539,192 @@ class Answer:
                         - Future events that were "rolled back" are discarded permanently.
                         - State at exactly 'timestamp' must be preserved (i.e., events with time == timestamp remain).
         '''
-        self._checks(ts=timestamp)
-        to_pop = [pkg for pkg in self.pkgs if self.pkgs[pkg].create_ts>timestamp]
-        for pkg in to_pop:
-            self.pkgs.pop(pkg)
-        for pkg in self.pkgs.values():
-            pkg.rollback(timestamp)
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        if self.store is not None: # logged first, like every write
+            self.store.rollback(timestamp)
+            if self.pending is None:
+                self.store.flush()
+        self._clear_cache()
+        if self.lazy_rollback: # packages are truncated by _resolve when next touched, or by compact
+            self.cutoffs.append(timestamp)
+            self.epoch += 1
+            self.unsettled.append(timestamp)
+        else:
+            for pid in self._changed_after(timestamp):
+                pkg = self.pkgs.get(pid)
+                if pkg is None: # deleted by an earlier rollback
+                    continue
+                self._rollback_pkg(pid, pkg, timestamp)
+
+class ShardedRegistry:
+    '''
+    registry partitioned into Answer shards by a crc32 of the tracking_id. every shard has its own lock
+    and op sequence, so writers to different shards never contend and same-timestamp events of a
+    package keep their insertion order. queries spanning shards merge per-shard results taken under
+    each shard's lock; ROLLBACK holds every shard lock so no write interleaves with it
+    '''
+    # position of tracking_id in the args of methods served by a single shard. PKG_HISTORY is not batched
+    # with them, since its wrapper has to read the timelines under the shard lock
+    _routed = {"PKG_CREATE": 0, "PKG_GET": 0, "PKG_SET_WEIGHT": 0, "PKG_REDIRECT": 0, "PKG_CREATE_AT": 1,
+               "PKG_SET_WEIGHT_AT": 1, "PKG_REDIRECT_AT": 1, "PKG_MARK_DELIVERED_AT": 1, "PKG_GET_AT": 1}
+
+    def __init__(self, shards=16, data_dir=None, **kwargs):
+        self.shards = [Answer(data_dir=None if data_dir is None else Path(data_dir) / f"shard{i}", **kwargs) for i in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def run(self, method: str, *args, **kwargs):
+        return getattr(self, method)(*args, **kwargs)
+
+    def run_batch(self, ops):
+        '''
+        like Answer.run_batch. consecutive single-package operations are grouped per shard and each group
+        runs as one shard batch under one lock acquisition; cross-shard operations run in between
+        '''
+        ops = list(ops)
+        results = [None] * len(ops)
+        groups = defaultdict(list) # shard -> [(position, op)]
+
+        def drain():
+            for i, group in groups.items():
+                with self.locks[i]:
+                    done = self.shards[i].run_batch(op for _, op in group)
+                for (pos, _), result in zip(group, done):
+                    results[pos] = result
+            groups.clear()
+
+        for pos, (method, args, kwargs) in enumerate(ops):
+            try:
+                if method in self._routed:
+                    groups[self._route(method, args, kwargs)].append((pos, (method, args, kwargs)))
+                    continue
+                drain()
+                results[pos] = self.run(method, *args, **kwargs)
+            except Exception as e:
+                results[pos] = e
+        drain()
+        return results
+
+    def close(self):
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.close()
+
+    def _shard(self, pid):
+        return zlib.crc32(pid.encode()) % len(self.shards)
+
+    def _route(self, method, args, kwargs):
+        return self._shard(kwargs["tracking_id"] if "tracking_id" in kwargs else args[self._routed[method]])
+
+    def _on(self, pid, method, *args):
+        i = self._shard(pid)
+        with self.locks[i]:
+            return getattr(self.shards[i], method)(*args)
+
+    def _on_all(self, method, *args):
+        results = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                results.append(getattr(shard, method)(*args))
+        return results
+
+    # single-shard operations
+    def PKG_CREATE(self, tracking_id: str, weight: int, destination: str):
+        return self._on(tracking_id, "PKG_CREATE", tracking_id, weight, destination)
+
+    def PKG_GET(self, tracking_id: str):
+        return self._on(tracking_id, "PKG_GET", tracking_id)
+
+    def PKG_SET_WEIGHT(self, tracking_id: str, weight: int):
+        return self._on(tracking_id, "PKG_SET_WEIGHT", tracking_id, weight)
+
+    def PKG_REDIRECT(self, tracking_id: str, destination: str):
+        return self._on(tracking_id, "PKG_REDIRECT", tracking_id, destination)
+
+    def PKG_CREATE_AT(self, timestamp: int, tracking_id: str, weight: int, destination: str):
+        return self._on(tracking_id, "PKG_CREATE_AT", timestamp, tracking_id, weight, destination)
+
+    def PKG_SET_WEIGHT_AT(self, timestamp: int, tracking_id: str, weight: int):
+        return self._on(tracking_id, "PKG_SET_WEIGHT_AT", timestamp, tracking_id, weight)
+
+    def PKG_REDIRECT_AT(self, timestamp: int, tracking_id: str, destination: str):
+        return self._on(tracking_id, "PKG_REDIRECT_AT", timestamp, tracking_id, destination)
+
+    def PKG_MARK_DELIVERED_AT(self, timestamp: int, tracking_id: str):
+        return self._on(tracking_id, "PKG_MARK_DELIVERED_AT", timestamp, tracking_id)
+
+    def PKG_GET_AT(self, timestamp: int, tracking_id: str):
+        return self._on(tracking_id, "PKG_GET_AT", timestamp, tracking_id)
+
+    def PKG_HISTORY(self, tracking_id: str, start_ts: int, end_ts: int):
+        i = self._shard(tracking_id)
+        with self.locks[i]: # read the timelines before the lock is released
+            changes = list(self.shards[i].PKG_HISTORY(tracking_id, start_ts, end_ts))
+        return (change for change in changes)
+
+    # cross-shard operations
+    def PKG_LIST_BY_DEST(self, destination: str):
+        return list(heapq.merge(*self._on_all("PKG_LIST_BY_DEST", destination)))
+
+    def PKG_LIST_BY_DEST_AT(self, timestamp: int, destination: str):
+        return list(heapq.merge(*self._on_all("PKG_LIST_BY_DEST_AT", timestamp, destination)))
+
+    def PKG_TOP_N_HEAVIEST(self, n: int):
+        tops = self._on_all("PKG_TOP_N_HEAVIEST", n)
+        return list(islice(heapq.merge(*tops, key=lambda x: (-x[1], x[0])), n))
+
+    def PKG_AVG_WEIGHT(self):
+        count = tot = 0
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.compact()
+                count += shard.count
+                tot += shard.total_weight
+        return round(tot/count, 2) if count else None
+
+    def PKG_AVG_WEIGHT_BY_DEST(self, destination: str):
+        if destination is not None and not destination:
+            raise ValueError
+        count = tot = 0
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.compact()
+                code = shard.dest_ids.get(destination) # every shard interns its own codes
+                if code in shard.dest_totals:
+                    count += shard.dest_totals[code][0]
+                    tot += shard.dest_totals[code][1]
+        return round(tot/count, 2) if count else None
+
+    def PKG_TOTAL_WEIGHT(self):
+        return sum(self._on_all("PKG_TOTAL_WEIGHT"))
+
+    def PKG_COUNT(self):
+        return sum(self._on_all("PKG_COUNT"))
+
+    def PKG_LIST_ACTIVE_AT(self, timestamp: int):
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        active = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.compact()
+                active.append(list(shard.active.stab_items(timestamp)))
+        return (pid for _, pid in heapq.merge(*active))
+
+    def compact(self):
+        '''apply pending lazy rollbacks one shard at a time, e.g. from a background thread'''
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.compact()
+
+    def ROLLBACK(self, timestamp: int):
+        if timestamp is not None and timestamp < 0:
+            raise ValueError
+        for lock in self.locks: # always taken in shard order
+            lock.acquire()
+        try:
+            for shard in self.shards:
+                shard.ROLLBACK(timestamp)
+        finally:
+            for lock in self.locks:
+                lock.release()
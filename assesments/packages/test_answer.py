@@ -0,0 +1,540 @@
+import inspect
+import json
+import sys
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from pathlib import Path
+
+here = Path(__file__).parent
+sys.path.insert(0, str(here.parent)) # the runner and the benchmark live one level up
+
+import run_benchmark as benchmark
+from run_test_cases import load_answer
+
+answer = load_answer(here / "answer.py")
+
+try:
+    import numpy
+except ImportError: # analytics.py needs numpy; its checks are skipped without it
+    numpy = None
+
+def load_testcases(*levels):
+    '''(level, testcase_idx, operations) for every testcase of the given levels'''
+    for level in levels:
+        with open(here / f"testcases/level{level}.json", "r", encoding="utf-8") as f:
+            for testcase_idx, testcase in json.load(f).items():
+                yield level, testcase_idx, testcase
+
+def run_op(registry, operation):
+    '''output of one testcase operation; a raised exception is returned as its type name, like the expected outputs'''
+    try:
+        output = registry.run(operation["method"], *operation["args"], **operation["kwargs"])
+    except Exception as e:
+        return type(e).__name__
+    return list(output) if inspect.isgenerator(output) else output
+
+def op(method, *args, **kwargs):
+    return method, list(args), kwargs
+
+class RegistryTest(unittest.TestCase):
+
+    def check_testcases(self, make, levels=(1, 2, 3, 4)):
+        '''run the testcases of the given levels, each against a fresh registry from make()'''
+        for level, testcase_idx, testcase in load_testcases(*levels):
+            registry = make()
+            try:
+                for operation_idx, operation in enumerate(testcase):
+                    with self.subTest(level=level, testcase=testcase_idx, operation=operation_idx):
+                        self.assertEqual(run_op(registry, operation), operation["output"])
+            finally:
+                registry.close()
+
+    def assertSameState(self, registry, other, timestamps):
+        '''every point-in-time read and index query of two registries agrees'''
+        self.assertEqual(sorted(registry.pkgs), sorted(other.pkgs))
+        for pid in registry.pkgs:
+            self.assertEqual(list(registry.PKG_HISTORY(pid, 0, max(timestamps))), list(other.PKG_HISTORY(pid, 0, max(timestamps))))
+            for ts in timestamps:
+                self.assertEqual(registry.PKG_GET_AT(ts, pid), other.PKG_GET_AT(ts, pid))
+        for ts in timestamps:
+            self.assertEqual(list(registry.PKG_LIST_ACTIVE_AT(ts)), list(other.PKG_LIST_ACTIVE_AT(ts)))
+        for destination in registry.dest_names:
+            self.assertEqual(registry.PKG_LIST_BY_DEST(destination), other.PKG_LIST_BY_DEST(destination))
+            self.assertEqual(registry.PKG_AVG_WEIGHT_BY_DEST(destination), other.PKG_AVG_WEIGHT_BY_DEST(destination))
+        self.assertEqual(registry.PKG_TOP_N_HEAVIEST(len(registry.pkgs)), other.PKG_TOP_N_HEAVIEST(len(other.pkgs)))
+        self.assertEqual(registry.PKG_TOTAL_WEIGHT(), other.PKG_TOTAL_WEIGHT())
+
+class TestRunBatch(RegistryTest):
+
+    def test_results_match_op_position(self):
+        # streamed results reflect the registry when the op runs, not when the batch is done
+        ops = [op("PKG_CREATE_AT", 1, "x", 5, "A"), op("PKG_LIST_ACTIVE_AT", 3), op("PKG_HISTORY", "x", 0, 10),
+               op("PKG_SET_WEIGHT_AT", 2, "x", 9), op("ROLLBACK", 0)]
+        results = answer.Answer().run_batch(ops)
+        self.assertEqual(list(results[1]), ["x"])
+        self.assertEqual(list(results[2]), [[1, "weight", 5], [1, "destination", "A"]])
+
+    def check_matches_sequential(self, ops, make, timestamps):
+        batched, sequential = make(), make()
+        results = [list(r) if inspect.isgenerator(r) else type(r).__name__ if isinstance(r, Exception) else r
+                   for r in batched.run_batch([(o["method"], o["args"], o["kwargs"]) for o in ops])]
+        self.assertEqual(results, [run_op(sequential, operation) for operation in ops])
+        batched.compact(), sequential.compact() # drops the packages a lazy rollback left behind
+        self.assertSameState(batched, sequential, timestamps)
+        batched.close(), sequential.close()
+
+    def test_bulk_writes_match_sequential(self):
+        # runs of timestamped writes take the bulk path; reads and rollbacks in between end the run
+        for seed in range(3):
+            for read_fraction in (0, 0.2):
+                ops = list(benchmark.workload(seed=seed, packages=200, updates=5, out_of_order=0.3, rollback_rate=0.05,
+                                              read_fraction=read_fraction, destinations=5, window=50))
+                for lazy_rollback in (False, True):
+                    with self.subTest(seed=seed, read_fraction=read_fraction, lazy_rollback=lazy_rollback):
+                        self.check_matches_sequential(ops, lambda: answer.Answer(lazy_rollback=lazy_rollback),
+                                                      range(0, 3000, 11))
+
+    def test_bulk_writes_fail_like_sequential(self):
+        ops = [{"method": method, "args": list(args), "kwargs": {}} for method, *args in [
+            ("PKG_SET_WEIGHT_AT", 1, "x", 3), ("PKG_CREATE_AT", 5, "x", 5, "A"), ("PKG_CREATE_AT", 6, "x", 1, "B"),
+            ("PKG_CREATE_AT", 6, "", 1, "B"), ("PKG_CREATE_AT", 6, "y", 1.0, "B"), ("PKG_CREATE_AT", 6, "y", "1", "B"),
+            ("PKG_CREATE_AT", 6, "y", 1, ""), ("PKG_REDIRECT_AT", 4, "x", "B"), ("PKG_REDIRECT_AT", 7, "x", ""),
+            ("PKG_SET_WEIGHT_AT", 9, "x", -1), ("PKG_MARK_DELIVERED_AT", 12, "x"), ("PKG_SET_WEIGHT_AT", 8, "x", 7),
+            ("PKG_SET_WEIGHT_AT", 12, "x", 7), ("PKG_MARK_DELIVERED_AT", 10, "x"), ("PKG_SET_WEIGHT_AT", 11, "x", 9),
+            ("PKG_CREATE_AT", -1, "z", 1, "C"), ("PKG_CREATE_AT", 3, "z", 1, "C"), ("PKG_REDIRECT_AT", 3, "z", "A"),
+            ("PKG_CREATE", "w", 2, "A"), ("PKG_SET_WEIGHT_AT", 4, "w", 3), ("PKG_SET_WEIGHT", "z", 1)]]
+        with tempfile.TemporaryDirectory() as data_dir:
+            count = iter(range(10))
+            self.check_matches_sequential(ops, lambda: answer.Answer(data_dir=f"{data_dir}/{next(count)}"), range(15))
+            batched, sequential = answer.Answer(data_dir=f"{data_dir}/0"), answer.Answer(data_dir=f"{data_dir}/1")
+            self.assertSameState(batched, sequential, range(15))
+            batched.close(), sequential.close()
+
+class TestValidation(RegistryTest):
+
+    def test_none_arguments_are_not_validated(self):
+        # the per-method checks skip None arguments, like the keyword-argument checks they replaced
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        registry.PKG_CREATE("y", 7, "B")
+        self.assertEqual(registry.PKG_TOP_N_HEAVIEST(None), [["y", 7, "B"], ["x", 5, "A"]])
+        self.assertEqual(registry.PKG_LIST_BY_DEST(None), [])
+        self.assertEqual(registry.PKG_AVG_WEIGHT_BY_DEST(None), None)
+        self.assertEqual(registry.PKG_LIST_BY_DEST_AT(None, "A"), ["x"])
+        registry.PKG_SET_WEIGHT_AT(4, "x", 6)
+        registry.PKG_MARK_DELIVERED_AT(9, "x")
+        self.assertEqual(list(registry.PKG_LIST_ACTIVE_AT(None)), ["y", "x"]) # like PKG_LIST_BY_DEST_AT, None ignores time
+        self.assertEqual(list(registry.PKG_HISTORY("x", None, 5)), [[1, "weight", 5], [1, "destination", "A"], [4, "weight", 6]])
+        self.assertEqual(list(registry.PKG_HISTORY("x", 4, None)), [[4, "weight", 6], [9, "delivered", 9]])
+        self.assertEqual(len(list(registry.PKG_HISTORY("x", None, None))), 4)
+        sharded = answer.ShardedRegistry(shards=4)
+        sharded.PKG_CREATE_AT(1, "x", 5, "A")
+        self.assertEqual(list(sharded.PKG_LIST_ACTIVE_AT(None)), ["x"])
+        self.assertEqual(list(sharded.PKG_HISTORY("x", None, None)), [[1, "weight", 5], [1, "destination", "A"]])
+        self.assertRaises(ValueError, registry.PKG_SET_WEIGHT, None, -1)
+        self.assertRaises(KeyError, registry.PKG_SET_WEIGHT, None, 1)
+        self.assertRaises(ValueError, registry.PKG_REDIRECT, None, "")
+        self.assertRaises(KeyError, registry.PKG_REDIRECT, None, "C")
+        self.assertRaises(ValueError, registry.PKG_CREATE, "zz", None, "")
+        self.assertRaises(ValueError, registry.PKG_CREATE, "zz", -1, None)
+        self.assertEqual(registry.PKG_GET("zz"), None)
+
+    def test_invalid_arguments(self):
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        self.assertRaises(ValueError, registry.PKG_CREATE_AT, 2, "x", 5, "A")
+        self.assertRaises(ValueError, registry.PKG_CREATE_AT, 2, "", 5, "A")
+        self.assertRaises(ValueError, registry.PKG_CREATE_AT, 2, "y", 5.0, "A")
+        self.assertRaises(ValueError, registry.PKG_CREATE_AT, -1, "y", 5, "A")
+        self.assertRaises(KeyError, registry.PKG_SET_WEIGHT_AT, 0, "x", -1) # not created yet as of 0
+        self.assertRaises(ValueError, registry.PKG_SET_WEIGHT_AT, 2, "x", -1)
+        self.assertRaises(KeyError, registry.PKG_REDIRECT_AT, 2, "y", "B")
+        self.assertRaises(ValueError, registry.PKG_TOP_N_HEAVIEST, -1)
+        self.assertRaises(ValueError, registry.PKG_HISTORY, "x", 3, 2)
+        self.assertRaises(ValueError, registry.ROLLBACK, -1)
+
+    def test_untimed_writes_to_timed_packages(self):
+        # an untimed change is stored before every timed event, so it is rejected instead of hidden
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(10, "x", 5, "NYC")
+        registry.PKG_SET_WEIGHT_AT(20, "x", 6)
+        self.assertRaises(ValueError, registry.PKG_SET_WEIGHT, "x", 99)
+        self.assertRaises(ValueError, registry.PKG_REDIRECT, "x", "SEA")
+        self.assertEqual(registry.PKG_GET("x"), [6, "NYC"])
+        self.assertEqual(registry.PKG_TOP_N_HEAVIEST(1), [["x", 6, "NYC"]])
+
+        registry.PKG_CREATE("y", 1, "A")
+        registry.PKG_SET_WEIGHT("y", 2)
+        registry.PKG_REDIRECT("y", "B")
+        self.assertEqual(registry.PKG_GET("y"), [2, "B"])
+        registry.PKG_SET_WEIGHT_AT(5, "y", 3)
+        self.assertRaises(ValueError, registry.PKG_SET_WEIGHT, "y", 4)
+        self.assertEqual(registry.PKG_GET("y"), [3, "B"])
+
+class TestJournal(RegistryTest):
+
+    def test_testcases_without_checkpoints(self):
+        self.check_testcases(lambda: answer.Answer(checkpoint_every=None), levels=(3, 4))
+
+    def test_testcases_with_every_timestamp_folded(self):
+        self.check_testcases(lambda: answer.Answer(checkpoint_every=1), levels=(3, 4))
+
+    def test_journal_is_folded_by_default(self):
+        registry = answer.Answer()
+        for ts in range(1000):
+            registry.PKG_CREATE_AT(ts, f"p{ts}", 1, "A")
+        self.assertLess(len(registry.journal), 2 * registry.checkpoint_every)
+        registry.ROLLBACK(500)
+        self.assertEqual(registry.PKG_COUNT(), 501)
+        self.assertEqual(registry.PKG_GET_AT(600, "p500"), [1, "A"])
+
+class TestReadCache(RegistryTest):
+
+    def test_testcases_with_small_cache(self):
+        self.check_testcases(lambda: answer.Answer(cache_size=2), levels=(3, 4))
+
+    def test_testcases_without_cache(self):
+        self.check_testcases(lambda: answer.Answer(cache_size=0), levels=(3, 4))
+
+    def test_evicts_least_recently_used(self):
+        registry = answer.Answer(cache_size=2)
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        registry.PKG_GET_AT(1, "x")
+        registry.PKG_GET_AT(2, "x")
+        registry.PKG_GET_AT(1, "x") # (x, 2) is now the least recently used
+        registry.PKG_GET_AT(3, "x")
+        self.assertEqual(list(registry.cache), [("x", 1), ("x", 3)])
+        self.assertEqual(registry.cached_ts["x"], {1, 3})
+        self.assertEqual(registry.cache_info(), {"hits": 1, "misses": 3, "size": 2, "max_size": 2})
+
+    def test_write_invalidates_reads_from_its_timestamp(self):
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        registry.PKG_CREATE_AT(1, "y", 7, "A")
+        for ts in (1, 5, 9):
+            registry.PKG_GET_AT(ts, "x")
+        registry.PKG_GET_AT(9, "y")
+        registry.PKG_SET_WEIGHT_AT(5, "x", 6)
+        self.assertEqual(set(registry.cache), {("x", 1), ("y", 9)})
+        self.assertEqual(registry.PKG_GET_AT(9, "x"), [6, "A"])
+        registry.PKG_REDIRECT_AT(2, "x", "B")
+        registry.PKG_MARK_DELIVERED_AT(8, "y")
+        self.assertEqual(set(registry.cache), {("x", 1)})
+        self.assertEqual(registry.PKG_GET_AT(9, "y"), None)
+
+    def test_rollback_clears_cache(self):
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        registry.PKG_SET_WEIGHT_AT(3, "x", 6)
+        self.assertEqual(registry.PKG_GET_AT(4, "x"), [6, "A"])
+        registry.ROLLBACK(2)
+        self.assertEqual(len(registry.cache), 0)
+        self.assertEqual(registry.PKG_GET_AT(4, "x"), [5, "A"])
+
+    def test_cached_results_are_copies(self):
+        registry = answer.Answer()
+        registry.PKG_CREATE_AT(1, "x", 5, "A")
+        registry.PKG_GET_AT(1, "x").append("changed")
+        self.assertEqual(registry.PKG_GET_AT(1, "x"), [5, "A"])
+
+class TestEventStore(RegistryTest):
+
+    timestamps = range(0, 102)
+
+    def check_reopen(self, **kwargs):
+        '''run the level 3-4 testcases on a persistent registry that is reopened after every operation'''
+        for level, testcase_idx, testcase in load_testcases(3, 4):
+            with tempfile.TemporaryDirectory() as data_dir:
+                memory = answer.Answer()
+                registry = answer.Answer(data_dir=data_dir, **kwargs)
+                for operation_idx, operation in enumerate(testcase):
+                    with self.subTest(level=level, testcase=testcase_idx, operation=operation_idx):
+                        output = run_op(registry, operation)
+                        self.assertEqual(output, operation["output"])
+                        self.assertEqual(run_op(memory, operation), output)
+                        registry.close()
+                        registry = answer.Answer(data_dir=data_dir, **kwargs)
+                        self.assertSameState(registry, memory, self.timestamps)
+                registry.close()
+
+    def test_reopen(self):
+        self.check_reopen()
+
+    def test_reopen_with_snapshots(self):
+        self.check_reopen(snapshot_every=2)
+
+    def test_snapshot_restarts_log(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            registry = answer.Answer(data_dir=data_dir, snapshot_every=3)
+            for ts in range(1, 5):
+                registry.PKG_CREATE_AT(ts, f"p{ts}", ts, "A")
+            self.assertEqual(registry.store.generation, 1)
+            self.assertEqual(len(registry.store.rec_ts), 1) # only the write after the snapshot
+            registry.close()
+            reopened = answer.Answer(data_dir=data_dir, snapshot_every=3)
+            self.assertSameState(reopened, registry, range(6))
+            reopened.close()
+
+    def test_reopen_workload(self):
+        # the journal rebuilt from a snapshot must name every package a later rollback truncates
+        for lazy_rollback in (False, True):
+            with tempfile.TemporaryDirectory() as data_dir:
+                make = lambda: answer.Answer(data_dir=data_dir, snapshot_every=50, checkpoint_every=4, lazy_rollback=lazy_rollback)
+                memory, registry = answer.Answer(), make()
+                for i, operation in enumerate(benchmark.workload(seed=3, packages=100, updates=5, out_of_order=0.3,
+                                                                 rollback_rate=0.05, destinations=5, window=50,
+                                                                 extended_reads=True)):
+                    with self.subTest(lazy_rollback=lazy_rollback, operation=i):
+                        self.assertEqual(run_op(registry, operation), run_op(memory, operation))
+                    if i % 97 == 0:
+                        registry.close()
+                        registry = make()
+                registry.compact()
+                self.assertSameState(registry, memory, range(0, 1500, 7))
+                registry.close()
+
+    def test_snapshot_keeps_creation_values(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            registry = answer.Answer(data_dir=data_dir, snapshot_every=3)
+            registry.PKG_CREATE_AT(10, "x", 5, "NYC")
+            self.assertRaises(ValueError, registry.PKG_SET_WEIGHT, "x", 99)
+            registry.PKG_CREATE("y", 1, "B")
+            registry.PKG_SET_WEIGHT("y", 2)
+            registry.PKG_SET_WEIGHT_AT(12, "y", 3)
+            registry.PKG_CREATE_AT(11, "z", 1, "B")
+            self.assertEqual(registry.store.generation, 1)
+            registry.close()
+            reopened = answer.Answer(data_dir=data_dir, snapshot_every=3)
+            self.assertEqual(reopened.PKG_GET_AT(15, "x"), [5, "NYC"])
+            self.assertSameState(reopened, registry, range(16))
+            reopened.close()
+
+    def test_torn_record_is_dropped(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            registry = answer.Answer(data_dir=data_dir)
+            registry.PKG_CREATE_AT(1, "x", 5, "A")
+            registry.PKG_SET_WEIGHT_AT(2, "x", 6)
+            registry.close()
+            log = registry.store.log_path
+            size = log.stat().st_size
+            with open(log, "ab") as f: # a crash halfway through writing a record
+                f.write(answer.EventStore.encode(answer.EventStore.REDIRECT, 3, "x", dest="B")[:-1])
+            reopened = answer.Answer(data_dir=data_dir)
+            self.assertEqual(log.stat().st_size, size)
+            self.assertEqual(reopened.PKG_GET_AT(3, "x"), [6, "A"])
+            reopened.PKG_REDIRECT_AT(4, "x", "C")
+            reopened.close()
+            reopened = answer.Answer(data_dir=data_dir)
+            self.assertEqual(reopened.PKG_GET_AT(4, "x"), [6, "C"])
+            reopened.close()
+
+    def test_rollback_truncates_log_tail(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            registry = answer.Answer(data_dir=data_dir)
+            registry.PKG_CREATE_AT(1, "x", 5, "A")
+            size = registry.store.log_path.stat().st_size
+            registry.PKG_SET_WEIGHT_AT(3, "x", 6)
+            registry.PKG_REDIRECT_AT(4, "x", "B")
+            registry.ROLLBACK(2)
+            self.assertEqual(registry.store.log_path.stat().st_size, size)
+            registry.PKG_SET_WEIGHT_AT(5, "x", 7)
+            registry.PKG_SET_WEIGHT_AT(2, "x", 8) # an event before the cutoff that is not in the tail
+            registry.ROLLBACK(4)
+            self.assertEqual(registry.store.rec_ts[-1], 4) # logged as a rollback record
+            registry.close()
+            reopened = answer.Answer(data_dir=data_dir)
+            self.assertSameState(reopened, registry, range(7))
+            reopened.close()
+
+    def test_failed_record_leaves_registry_untouched(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            registry = answer.Answer(data_dir=data_dir)
+            registry.PKG_CREATE_AT(1, "x", 5, "A")
+            size = registry.store.log_path.stat().st_size
+            with self.assertRaises(ValueError):
+                registry.PKG_REDIRECT_AT(2, "x", "B" * 70000)
+            with self.assertRaises(ValueError):
+                registry.PKG_CREATE_AT(2, "y" * 70000, 5, "A")
+            with self.assertRaises(ValueError):
+                registry.PKG_SET_WEIGHT_AT(2, "x", 2**63)
+            self.assertEqual(registry.PKG_GET_AT(3, "x"), [5, "A"])
+            self.assertEqual(registry.PKG_LIST_BY_DEST("A"), ["x"])
+            self.assertEqual(registry.PKG_COUNT(), 1)
+            self.assertEqual(registry.store.log_path.stat().st_size, size)
+            registry.close()
+
+class TestShardedRegistry(RegistryTest):
+
+    def test_testcases(self):
+        self.check_testcases(lambda: answer.ShardedRegistry(shards=4))
+
+    def test_testcases_persistent(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            count = iter(range(1000))
+            self.check_testcases(lambda: answer.ShardedRegistry(shards=4, data_dir=f"{data_dir}/{next(count)}"), levels=(3, 4))
+
+    def test_run_batch_matches_answer(self):
+        for level, testcase_idx, testcase in load_testcases(3, 4):
+            ops = [(operation["method"], operation["args"], operation["kwargs"]) for operation in testcase]
+            expected = [operation["output"] for operation in testcase]
+            results = [list(r) if inspect.isgenerator(r) else type(r).__name__ if isinstance(r, Exception) else r
+                       for r in answer.ShardedRegistry(shards=4).run_batch(ops)]
+            with self.subTest(level=level, testcase=testcase_idx):
+                self.assertEqual(results, expected)
+
+    def test_run_batch_history_is_read_in_place(self):
+        ops = [op("PKG_CREATE_AT", 1, "x", 5, "A"), op("PKG_HISTORY", "x", 0, 10), op("PKG_SET_WEIGHT_AT", 2, "x", 9)]
+        results = answer.ShardedRegistry(shards=4).run_batch(ops)
+        self.assertEqual(list(results[1]), [[1, "weight", 5], [1, "destination", "A"]])
+
+    def test_concurrent_writers(self):
+        registry = answer.ShardedRegistry(shards=4)
+        single = answer.Answer()
+        errors = []
+
+        def write(worker):
+            try:
+                for i in range(200):
+                    pid = f"w{worker}-{i}"
+                    registry.PKG_CREATE_AT(i, pid, i, f"D{i % 5}")
+                    registry.PKG_SET_WEIGHT_AT(i + 1, pid, i + 1)
+                    registry.PKG_SET_WEIGHT_AT(i + 1, pid, i + 2) # same timestamp, later insertion wins
+                    if i % 3 == 0:
+                        registry.PKG_MARK_DELIVERED_AT(i + 2, pid)
+                    registry.PKG_LIST_BY_DEST(f"D{i % 5}")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        for worker in range(8):
+            for i in range(200):
+                pid = f"w{worker}-{i}"
+                single.PKG_CREATE_AT(i, pid, i, f"D{i % 5}")
+                single.PKG_SET_WEIGHT_AT(i + 1, pid, i + 1)
+                single.PKG_SET_WEIGHT_AT(i + 1, pid, i + 2)
+                if i % 3 == 0:
+                    single.PKG_MARK_DELIVERED_AT(i + 2, pid)
+        registry.ROLLBACK(100)
+        single.ROLLBACK(100)
+        for destination in single.dest_names:
+            self.assertEqual(registry.PKG_LIST_BY_DEST(destination), single.PKG_LIST_BY_DEST(destination))
+            self.assertEqual(registry.PKG_AVG_WEIGHT_BY_DEST(destination), single.PKG_AVG_WEIGHT_BY_DEST(destination))
+        for ts in (0, 50, 99, 100, 150):
+            self.assertEqual(list(registry.PKG_LIST_ACTIVE_AT(ts)), list(single.PKG_LIST_ACTIVE_AT(ts)))
+        self.assertEqual(registry.PKG_TOP_N_HEAVIEST(20), single.PKG_TOP_N_HEAVIEST(20))
+        self.assertEqual(registry.PKG_COUNT(), single.PKG_COUNT())
+
+class TestLazyRollback(RegistryTest):
+
+    def test_testcases(self):
+        self.check_testcases(lambda: answer.Answer(lazy_rollback=True))
+
+    def test_testcases_with_checkpoints(self):
+        self.check_testcases(lambda: answer.Answer(lazy_rollback=True, checkpoint_every=1), levels=(3, 4))
+
+    def test_testcases_sharded(self):
+        self.check_testcases(lambda: answer.ShardedRegistry(shards=4, lazy_rollback=True), levels=(4,))
+
+    def test_matches_eager_rollback(self):
+        for seed in range(3):
+            eager, lazy = answer.Answer(), answer.Answer(lazy_rollback=True, checkpoint_every=8)
+            for operation in benchmark.workload(seed=seed, packages=200, updates=5, out_of_order=0.3, rollback_rate=0.05,
+                                                destinations=5, window=50, extended_reads=True):
+                with self.subTest(seed=seed, operation=operation):
+                    self.assertEqual(run_op(lazy, operation), run_op(eager, operation))
+            with self.subTest(seed=seed):
+                self.assertSameState(lazy, eager, range(0, 3000, 11))
+
+    def test_untouched_packages_are_not_truncated(self):
+        registry = answer.Answer(lazy_rollback=True)
+        for i in range(10):
+            registry.PKG_CREATE_AT(i, f"p{i}", i, "A")
+        registry.PKG_SET_WEIGHT_AT(20, "p3", 99)
+        truncated = []
+        rollback_pkg = registry._rollback_pkg
+        registry._rollback_pkg = lambda pid, pkg, ts: (truncated.append(pid), rollback_pkg(pid, pkg, ts))
+        registry.ROLLBACK(15)
+        registry.ROLLBACK(30) # nothing after it
+        for i in range(10):
+            self.assertEqual(registry.PKG_GET_AT(40, f"p{i}"), [i, "A"])
+        self.assertEqual(truncated, ["p3"])
+        self.assertTrue(all(pkg.epoch == registry.epoch for pkg in registry.pkgs.values()))
+
+@unittest.skipUnless(numpy, "analytics.py requires numpy")
+class TestFleetColumns(RegistryTest):
+
+    def registry(self):
+        '''a registry with out-of-order events, deliveries, rollbacks and untimed packages'''
+        registry = answer.Answer()
+        registry.PKG_CREATE("untimed", 7, "CITY0")
+        registry.PKG_SET_WEIGHT("untimed", 8)
+        registry.PKG_CREATE("untimed2", 9, "ELSEWHERE")
+        for operation in benchmark.workload(seed=1, packages=200, updates=5, out_of_order=0.2, rollback_rate=0.02,
+                                            destinations=5, window=50):
+            run_op(registry, operation)
+        return registry
+
+    def test_matches_point_queries(self):
+        analytics = load_answer(here / "analytics.py")
+        registry = self.registry()
+        fleet = analytics.FleetColumns.from_answer(registry)
+        timestamps = list(range(0, max(pkg.create_ts or 0 for pkg in registry.pkgs.values()) + 100, 7))
+
+        alive, weights, codes = fleet.alive_as_of(timestamps), fleet.weight_as_of(timestamps), fleet.dest_as_of(timestamps)
+        counts, totals = fleet.count_by_dest(timestamps), fleet.total_weight_by_dest(timestamps)
+        active = fleet.count_active(timestamps)
+        for row, ts in enumerate(timestamps):
+            for i, pid in enumerate(fleet.ids):
+                found = registry.PKG_GET_AT(ts, pid)
+                with self.subTest(ts=ts, tracking_id=pid):
+                    self.assertEqual(bool(alive[row, i]), found is not None)
+                    if found is not None:
+                        self.assertEqual([int(weights[row, i]), fleet.destinations[codes[row, i]]], found)
+            self.assertEqual(int(active[row]), len(list(registry.PKG_LIST_ACTIVE_AT(ts))))
+            for code, destination in enumerate(fleet.destinations):
+                listed = registry.PKG_LIST_BY_DEST_AT(ts, destination)
+                with self.subTest(ts=ts, destination=destination):
+                    self.assertEqual(int(counts[row, code]), len(listed))
+                    self.assertEqual(int(totals[row, code]), sum(registry.PKG_GET_AT(ts, pid)[0] for pid in listed))
+
+    def test_group_by_scales_with_packages(self):
+        # a dense (timestamps x packages) intermediate would need hundreds of bytes per package here
+        analytics = load_answer(here / "analytics.py")
+        n, per, destinations = 200_000, 3, 50
+        rng = numpy.random.default_rng(0)
+        create_ts = rng.integers(0, 100_000, n)
+        weight_ts = numpy.sort(create_ts[:, None] + rng.integers(0, 5_000, (n, per)), axis=1)
+        weight_ts[:, 0] = create_ts
+        weight_offsets = analytics.FleetColumns._offsets(numpy.full(n, per))
+        fleet = analytics.FleetColumns(
+            ids=numpy.arange(n).astype(object), create_ts=create_ts, delivery_ts=create_ts + rng.integers(1, 20_000, n),
+            weight=(weight_offsets, weight_ts.ravel(), rng.integers(1, 100, n * per)),
+            destination=(analytics.FleetColumns._offsets(numpy.ones(n, dtype=numpy.int64)), create_ts, rng.integers(0, destinations, n)),
+            destinations=numpy.array([f"CITY{i}" for i in range(destinations)], dtype=object))
+        timestamps = numpy.linspace(0, 110_000, 24).astype(numpy.int64)
+
+        tracemalloc.start()
+        try:
+            totals = fleet.total_weight_by_dest(timestamps)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 64 * n)
+
+        # the same totals from a pass over every event: a package's latest weight is its last event at or before ts
+        for row, ts in enumerate(timestamps):
+            alive = (fleet.create_ts <= ts) & (ts < fleet.delivery_ts)
+            latest = weight_offsets[:-1] + numpy.add.reduceat(fleet.weight_ts <= ts, weight_offsets[:-1]) - 1
+            expected = numpy.bincount(fleet.dest_codes[alive], weights=fleet.weight_vals[latest[alive]], minlength=destinations)
+            self.assertTrue(numpy.array_equal(totals[row], expected.astype(numpy.int64)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import argparse
+import inspect
+import json
+import random
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict
+from pathlib import Path
+
+from run_test_cases import load_answer
+
+def operation(method, *args, **kwargs):
+    return {"method": method, "args": list(args), "kwargs": kwargs}
+
+def workload(seed=0, packages=10_000, updates=10, out_of_order=0.1, rollback_rate=0.0, read_fraction=0.2,
+             destinations=50, window=1_000, extended_reads=False):
+    '''
+    seeded stream of operations in the testcase {method, args, kwargs} format. creates `packages` packages and
+    `updates` weight changes, redirects or deliveries per package, interleaved in time; delivered packages get
+    no further updates. a fraction `out_of_order` of the updates lands up to `window` seconds in the past (never
+    before the package was created), each write is followed by a ROLLBACK up to `window` seconds back with
+    probability `rollback_rate`, and by a random query with probability `read_fraction`. queries only use the
+    level 1-4 methods of the spec, so any implementation can run the workload; `extended_reads` mixes in the
+    PKG_LIST_BY_DEST_AT, PKG_HISTORY, PKG_AVG_WEIGHT_BY_DEST and PKG_COUNT extensions of the packages answer
+    '''
+    rng = random.Random(seed)
+    cities = [f"CITY{i}" for i in range(destinations)]
+    live = [] # (create_ts, tracking_id) of packages that are neither delivered nor rolled back
+    created, creates_left, updates_left = 0, packages, packages * updates
+    now = 0
+
+    while creates_left > 0 or updates_left: # a rollback that empties `live` forces extra creates, past zero
+        now += 1
+        if not live or (creates_left > 0 and rng.random() * (creates_left + updates_left) < creates_left):
+            tracking_id = f"PKG{created:08d}"
+            created, creates_left = created + 1, creates_left - 1
+            live.append((now, tracking_id))
+            yield operation("PKG_CREATE_AT", now, tracking_id, rng.randint(1, 50_000), rng.choice(cities))
+        else:
+            updates_left -= 1
+            idx = rng.randrange(len(live))
+            create_ts, tracking_id = live[idx]
+            ts = rng.randint(max(create_ts, now - window), now) if rng.random() < out_of_order else now
+            kind = rng.random()
+            if kind < 0.5:
+                yield operation("PKG_SET_WEIGHT_AT", ts, tracking_id, rng.randint(1, 50_000))
+            elif kind < 0.95:
+                yield operation("PKG_REDIRECT_AT", ts, tracking_id, rng.choice(cities))
+            else: # later events for a delivered package would be rejected, so it stops receiving them
+                live[idx] = live[-1]
+                live.pop()
+                yield operation("PKG_MARK_DELIVERED_AT", ts, tracking_id)
+
+        if rollback_rate and rng.random() < rollback_rate:
+            cutoff = max(0, now - rng.randint(0, window))
+            live = [(create_ts, pid) for create_ts, pid in live if create_ts <= cutoff]
+            yield operation("ROLLBACK", cutoff)
+
+        if live and rng.random() < read_fraction:
+            ts = rng.randint(max(0, now - window), now)
+            kind = rng.random()
+            if not extended_reads:
+                if kind < 0.6:
+                    yield operation("PKG_GET_AT", ts, rng.choice(live)[1])
+                elif kind < 0.75:
+                    yield operation("PKG_LIST_BY_DEST", rng.choice(cities))
+                elif kind < 0.9:
+                    yield operation("PKG_TOP_N_HEAVIEST", 10)
+                else:
+                    yield operation("PKG_AVG_WEIGHT")
+            elif kind < 0.6:
+                yield operation("PKG_GET_AT", ts, rng.choice(live)[1])
+            elif kind < 0.75:
+                yield operation("PKG_LIST_BY_DEST_AT", ts, rng.choice(cities))
+            elif kind < 0.85:
+                tracking_id = rng.choice(live)[1]
+                yield operation("PKG_HISTORY", tracking_id, ts, now)
+            elif kind < 0.9:
+                yield operation("PKG_TOP_N_HEAVIEST", 10)
+            elif kind < 0.95:
+                yield operation("PKG_AVG_WEIGHT_BY_DEST", rng.choice(cities))
+            else:
+                yield operation("PKG_COUNT")
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def time_workload(module, ops):
+    '''
+    run every operation on a fresh Answer and return (elapsed seconds, method -> latencies in ns, method -> errors,
+    seconds spent in calls that raised). latencies only cover the calls that succeeded
+    '''
+    answer = module.Answer()
+    latencies, errors = defaultdict(lambda: array("q")), defaultdict(int)
+    failed = 0
+    clock = time.perf_counter_ns
+    begin = clock()
+    for op in ops:
+        start = clock()
+        try:
+            output = answer.run(op["method"], *op["args"], **op["kwargs"])
+            if inspect.isgenerator(output): # streamed results count once fully consumed
+                for _ in output:
+                    pass
+        except Exception:
+            errors[op["method"]] += 1
+            failed += clock() - start
+            continue
+        latencies[op["method"]].append(clock() - start)
+    elapsed = (clock() - begin) / 1e9
+    if hasattr(answer, "close"):
+        answer.close()
+    return elapsed, latencies, errors, failed / 1e9
+
+def peak_memory(module, ops):
+    '''peak traced bytes while running the operations on a fresh Answer'''
+    tracemalloc.start()
+    answer = module.Answer()
+    for op in ops:
+        try:
+            output = answer.run(op["method"], *op["args"], **op["kwargs"])
+            if inspect.isgenerator(output):
+                for _ in output:
+                    pass
+        except Exception:
+            pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def benchmark(module, args):
+    params = dict(seed=args.seed, packages=args.packages, updates=args.updates, out_of_order=args.out_of_order,
+                  rollback_rate=args.rollback_rate, read_fraction=args.read_fraction, extended_reads=args.extended_reads)
+    elapsed, latencies, errors, failed = time_workload(module, workload(**params))
+    succeeded = sum(len(samples) for samples in latencies.values())
+    report = {
+        "operations": succeeded + sum(errors.values()),
+        "errors": sum(errors.values()),
+        "seconds": round(elapsed, 3),
+        "throughput": round(succeeded / (elapsed - failed), 1) if succeeded else 0.0, # successful operations per second
+        "methods": {},
+    }
+    for method in sorted(set(latencies) | set(errors)):
+        ordered = sorted(latencies[method])
+        report["methods"][method] = {"calls": len(ordered) + errors[method], "errors": errors[method]}
+        if ordered:
+            report["methods"][method].update({
+                "p50_us": round(percentile(ordered, 0.50) / 1e3, 2),
+                "p99_us": round(percentile(ordered, 0.99) / 1e3, 2),
+                "mean_us": round(sum(ordered) / len(ordered) / 1e3, 2),
+            })
+    if not args.skip_memory: # a second, traced pass so tracing does not skew the latencies
+        report["peak_memory_bytes"] = peak_memory(module, workload(**params))
+    return report
+
+def main(args):
+    reports = {"workload": {"seed": args.seed, "packages": args.packages, "updates": args.updates,
+                            "out_of_order": args.out_of_order, "rollback_rate": args.rollback_rate,
+                            "read_fraction": args.read_fraction, "extended_reads": args.extended_reads}}
+    for path in args.answer:
+        reports[str(path)] = benchmark(load_answer(path), args)
+    output = json.dumps(reports, indent=4)
+    if args.out is None:
+        print(output)
+    else:
+        args.out.write_text(output + "\n", encoding="utf-8")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--answer",         type=Path, nargs="+", default=[Path(__file__).parent / "packages" / "answer.py"],
+                                            help="paths to the answer.py implementations to compare")
+    parser.add_argument("--seed",           type=int, default=0,
+                                            help="seed of the workload generator")
+    parser.add_argument("--packages",       type=int, default=10_000,
+                                            help="number of packages to create")
+    parser.add_argument("--updates",        type=int, default=10,
+                                            help="weight changes, redirects or deliveries per package")
+    parser.add_argument("--out_of_order",   type=float, default=0.1,
+                                            help="fraction of updates recorded in the past")
+    parser.add_argument("--rollback_rate",  type=float, default=0.0,
+                                            help="probability of a ROLLBACK after each write")
+    parser.add_argument("--read_fraction",  type=float, default=0.2,
+                                            help="probability of a query after each write")
+    parser.add_argument("--extended_reads", action="store_true",
+                                            help="also query the methods the packages answer adds beyond the spec")
+    parser.add_argument("--skip_memory",    action="store_true",
+                                            help="skip the traced pass measuring peak memory")
+    parser.add_argument("--out",            type=Path, default=None,
+                                            help="file to write the JSON report to. prints it when omitted")
+
+    args = parser.parse_args()
+
+    main(args)
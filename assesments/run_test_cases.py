@@ -1,10 +1,16 @@
 import argparse
 import unittest
 import json
+import itertools
 import importlib.util
+import inspect
+import pickle
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from instrument import Instrumentation
+
 exceptions = {
     "ArithmeticError": ArithmeticError,
     "FloatingPointError": FloatingPointError,
@@ -56,52 +62,172 @@ exceptions = {
     "UnicodeTranslateError": UnicodeTranslateError
 }
 
+def load_answer(answer_path):
+    spec = importlib.util.spec_from_file_location("module", answer_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["module"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def incorrect_str(level, testcase_idx, operation_idx, operation, got):
+    return (f"\n\nincorrect output:\n\tlevel: {level}\n\ttestcase: {testcase_idx}\n\toperation: {operation_idx}"
+            f"\n\tmethod: {operation['method']}\n\targs: {operation['args']}\n\tkwargs: {operation['kwargs']}"
+            f"\n\texpected: {operation['output']}\n\tgot: {got}\n")
+
+def run_testcase(module, testcase, instrumentation=None):
+    '''
+    run one testcase against a fresh Answer. returns None if every operation matches, otherwise
+    (operation_idx, output, expected, error) for the first mismatch, where error is the unexpected
+    exception that was raised, if any
+    '''
+
+    # reset the implementation for every testcase
+    answer = module.Answer()
+    if instrumentation is not None:
+        instrumentation.attach(answer)
+        try:
+            return run_operations(answer, testcase)
+        finally:
+            instrumentation.observe(answer)
+    return run_operations(answer, testcase)
+
+def run_operations(answer, testcase):
+
+    for operation_idx, operation in enumerate(testcase):
+
+        expected = operation["output"]
+        try:
+            output = answer.run(operation["method"], *operation["args"], **operation["kwargs"])
+            if inspect.isgenerator(output): # streamed results are compared as lists
+                output = list(output)
+        except Exception as e: # if it raises an exception, check if it is the expected one
+            if isinstance(expected, str) and expected in exceptions:
+                expected = exceptions[expected]
+                output = type(e)
+            else:
+                return operation_idx, type(e), expected, e
+
+        if output != expected:
+            return operation_idx, output, expected, None
+
+def read_trace(path):
+    '''
+    stream the operations of a line-delimited JSON trace. every line is one operation in the testcase
+    format plus the "level" and "testcase" it belongs to; the operations of a testcase are consecutive
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def group_trace(operations, level=0):
+    '''yield (level, testcase_idx, operations) per testcase of the trace, for one level or all of them (0)'''
+    if level != 0:
+        operations = (operation for operation in operations if operation["level"] == level)
+    for (testcase_level, testcase_idx), testcase in itertools.groupby(operations, key=lambda operation: (operation["level"], str(operation["testcase"]))):
+        yield testcase_level, testcase_idx, testcase
+
+def write_trace(testcases, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for level, level_testcases in testcases.items():
+            for testcase_idx, testcase in level_testcases.items():
+                for operation in testcase:
+                    f.write(json.dumps({"level": int(level), "testcase": testcase_idx, **operation}) + "\n")
+
+# answer module of a worker process when testcases run in parallel
+worker_module = None
+
+def init_worker(answer_path):
+    global worker_module
+    worker_module = load_answer(answer_path)
+
+def run_testcase_in_worker(testcase):
+    failure = run_testcase(worker_module, testcase)
+    if failure is not None:
+        try:
+            pickle.dumps(failure)
+        except Exception: # send back something the parent can report
+            operation_idx, output, expected, error = failure
+            failure = (operation_idx, repr(output), repr(expected),
+                       None if error is None else RuntimeError(f"{type(error).__name__}: {error}"))
+    return failure
+
 def main(args):
 
-    # load the testcases
+    # load the testcases. a trace is streamed by the test of each level instead
     testcases = {}
-    for testcase_idx in range(1,5):
+    for testcase_idx in ([] if args.trace else range(1,5)):
         with open(args.assesment_dir / Path(f"testcases/level{testcase_idx}.json"), "r", encoding="utf-8") as f:
             testcases[str(testcase_idx)] = json.load(f)
+
+    if args.export_trace is not None:
+        write_trace(testcases, args.export_trace)
+        return
     
     # load the answer dynamically
     answer_path = args.assesment_dir / Path("answer.py")
-    spec = importlib.util.spec_from_file_location("module", answer_path)
-    module = importlib.util.module_from_spec(spec)
-    sys.modules["module"] = module
-    spec.loader.exec_module(module)
+    module = load_answer(answer_path)
+
+    # timing around Answer.run, from --instrument or the ANSWER_INSTRUMENT environment variable
+    instrumentation = Instrumentation.from_env()
+    if args.instrument or args.profile_every:
+        instrumentation = Instrumentation(profile_every=args.profile_every, profile_dir=args.profile_dir)
+    if args.trace and args.jobs > 1:
+        print("traces are streamed through this process, ignoring --jobs")
+        args.jobs = 1
+    if instrumentation is not None and args.jobs > 1:
+        print("instrumentation runs the testcases in this process, ignoring --jobs")
+        args.jobs = 1
+
+    # with --jobs, every testcase of the selected levels is queued on a process pool up front
+    pool, futures = None, {}
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(answer_path,))
+        for level in (range(1,5) if args.level == 0 else [args.level]):
+            futures[level] = [pool.submit(run_testcase_in_worker, testcase) for testcase in testcases.get(str(level), {}).values()]
 
     # define the unit tests
     class Test(unittest.TestCase):
 
         def check_testcases(self, level):
 
-            for testcase_idx, testcase in testcases.get(str(level), {}).items():
-                
-                # reset the implementation for every testcase
-                answer = module.Answer()
-
-                for operation_idx, operation in enumerate(testcase):
-
-                    expected = operation["output"]
-                    method, args, kwargs = operation["method"], operation["args"], operation["kwargs"]
-                    incorrect_str = (f"\n\nincorrect output:\n\tlevel: {level}\n\ttestcase: {testcase_idx}\n\toperation: {operation_idx}"
-                                    f"\n\tmethod: {method}\n\targs: {args}\n\tkwargs: {kwargs}"
-                                    f"\n\texpected: {expected}")
-
-                    try:
-                        output = answer.run(method, *args, **kwargs)
-                    except Exception as e: # if it raises an exception, check if it is the expected one
-                        if isinstance(expected, str) and expected in exceptions:
-                            expected = exceptions[expected]
-                            output = type(e)
-                        else:
-                            print(incorrect_str + f"\n\tgot: {type(e)}\n")
-                            raise e
-
-                    incorrect_str += f"\n\tgot: {output}\n"
-                    self.assertEqual(output, expected, incorrect_str)
-            
+            if args.trace: # every level streams its own pass over the trace
+                return self.check_trace(level)
+
+            pending = futures.get(level)
+            for idx, (testcase_idx, testcase) in enumerate(testcases.get(str(level), {}).items()):
+
+                failure = pending[idx].result() if pending else run_testcase(module, testcase, instrumentation)
+                if failure is None:
+                    continue
+
+                if pending: # the level already failed, skip the testcases that have not started
+                    for future in pending[idx+1:]:
+                        future.cancel()
+
+                self.report_failure(level, testcase_idx, testcase[failure[0]], failure)
+
+        def report_failure(self, level, testcase_idx, operation, failure):
+            operation_idx, output, expected, error = failure
+            message = incorrect_str(level, testcase_idx, operation_idx, operation, output)
+            if error is not None:
+                print(message)
+                raise error
+            self.assertEqual(output, expected, message)
+
+        def check_trace(self, level):
+            for level, testcase_idx, operations in group_trace(read_trace(args.trace), level):
+
+                # only the operation being run is held, so a mismatch can still be reported
+                current = [None]
+                def tracked(operations=operations):
+                    for current[0] in operations:
+                        yield current[0]
+
+                failure = run_testcase(module, tracked(), instrumentation)
+                if failure is not None:
+                    self.report_failure(level, testcase_idx, current[0], failure)
+
         def test_level1(self):
             self.check_testcases(1)
 
@@ -126,7 +252,13 @@ def main(args):
         suite.addTest(Test(method_name))
 
     runner = unittest.TextTestRunner(verbosity=2)
-    runner.run(suite)
+    try:
+        runner.run(suite)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    if instrumentation is not None:
+        print(instrumentation.report())
 
 if __name__ == "__main__":
     
@@ -136,6 +268,18 @@ if __name__ == "__main__":
                                             help="path to the directory where the assesment is taking place")
     parser.add_argument("--level",          type=int, default=0, 
                                             help="levels to test (1-4). 0 means run all") 
+    parser.add_argument("--jobs",           type=int, default=1,
+                                            help="number of worker processes running testcases in parallel. 1 runs them serially")
+    parser.add_argument("--trace",          type=Path, default=None,
+                                            help="line-delimited JSON trace to stream instead of the testcases/level*.json files")
+    parser.add_argument("--export_trace",   type=Path, default=None,
+                                            help="write the testcases/level*.json files as a line-delimited trace and exit")
+    parser.add_argument("--instrument",     action="store_true",
+                                            help="report call counts, latencies and event log lengths per method")
+    parser.add_argument("--profile_every",  type=int, default=0,
+                                            help="run every n-th call under cProfile and report the slowest ones. implies --instrument")
+    parser.add_argument("--profile_dir",    type=Path, default=None,
+                                            help="directory to dump the cProfile stats of the slowest sampled calls to")
 
     args = parser.parse_args()
 